@@ -0,0 +1,114 @@
+import asyncio
+import os
+import subprocess
+import tempfile
+from typing import AsyncIterator, Iterator, Optional
+
+import numpy as np
+import torch
+
+from crabnlp.whisper import CHUNK_LENGTH, N_SAMPLES, SAMPLE_RATE
+
+
+MEMMAP_THRESHOLD = 64 * 1024 * 1024  # decoded audio bigger than this (about 35 minutes) is memory-mapped
+SAMPLE_WIDTH = 2  # int16
+
+
+def _ffmpeg_args(path) -> list:
+	return ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', str(path),
+			'-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-']
+
+
+def _to_tensor(block: bytearray) -> torch.Tensor:
+	if not block:
+		return torch.zeros((0, 1), dtype=torch.int16)
+	return torch.frombuffer(block, dtype=torch.int16).unsqueeze(1)
+
+
+def _read_errors(stderr) -> str:
+	stderr.seek(0)
+	return stderr.read().decode(errors='replace')
+
+
+def decode_stream(path, block_samples: int = N_SAMPLES) -> Iterator[bytes]:
+	"""Decodes any file ffmpeg understands (wav/ogg/mp3/m4a/...) into blocks of 16 kHz mono int16 PCM"""
+	# stderr goes to a file, a full pipe nobody reads would block ffmpeg
+	with tempfile.TemporaryFile() as stderr, \
+			subprocess.Popen(_ffmpeg_args(path), stdout=subprocess.PIPE, stderr=stderr) as proc:
+		while block := proc.stdout.read(block_samples * SAMPLE_WIDTH):
+			yield block
+		if proc.wait() != 0:
+			raise RuntimeError(f'Error decoding {path}: {_read_errors(stderr)}')
+
+
+def load_audio(path, memmap_threshold: int = MEMMAP_THRESHOLD, tmp_dir: Optional[str] = None) -> torch.Tensor:
+	"""Decodes a file into int16 PCM shaped (sample, 1).
+
+	Decoding is streamed, audio longer than `memmap_threshold` bytes is spilled into a temporary
+	file which is memory-mapped, so multi-hour files don't stay in process memory."""
+	buffer = bytearray()
+	spill = None
+	try:
+		for block in decode_stream(path):
+			if spill is None and len(buffer) + len(block) > memmap_threshold:
+				spill = tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.pcm', delete=False)
+				spill.write(buffer)
+				buffer = None
+			if spill is None:
+				buffer += block
+			else:
+				spill.write(block)
+		if spill is None:
+			return _to_tensor(buffer)
+
+		spill.close()
+		pcm = np.memmap(spill.name, dtype=np.int16, mode='c')
+		return torch.from_numpy(pcm).unsqueeze(1)
+	finally:
+		if spill is not None:
+			spill.close()
+			# the mapping stays valid after unlinking
+			os.unlink(spill.name)
+
+
+def iter_chunks(pcm: torch.Tensor, chunk_length: int = CHUNK_LENGTH, overlap: float = 0) -> Iterator[torch.Tensor]:
+	"""Yields views of `chunk_length` seconds, each one starts `overlap` seconds before the previous ends"""
+	size, keep = round(chunk_length * SAMPLE_RATE), round(overlap * SAMPLE_RATE)
+	assert size > keep, 'overlap should be shorter than a chunk'
+	for start in range(0, max(len(pcm) - keep, 1), size - keep):
+		yield pcm[start:start + size]
+
+
+assert [c.squeeze(1).tolist() for c in iter_chunks(torch.arange(10).unsqueeze(1), chunk_length=4 / SAMPLE_RATE)] == \
+	[[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+assert [c.squeeze(1).tolist() for c in iter_chunks(torch.arange(10).unsqueeze(1), chunk_length=4 / SAMPLE_RATE, overlap=1 / SAMPLE_RATE)] == \
+	[[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]]
+
+
+async def aiter_chunks(path, chunk_length: int = CHUNK_LENGTH, overlap: float = 0) -> AsyncIterator[torch.Tensor]:
+	"""Decodes a file in a subprocess and yields chunks as soon as they are decoded,
+	an async source for `whisper.stream_transcribe`"""
+	size, keep = round(chunk_length * SAMPLE_RATE) * SAMPLE_WIDTH, round(overlap * SAMPLE_RATE) * SAMPLE_WIDTH
+	assert size > keep, 'overlap should be shorter than a chunk'
+	stderr = tempfile.TemporaryFile()
+	proc = await asyncio.create_subprocess_exec(*_ffmpeg_args(path), stdout=asyncio.subprocess.PIPE, stderr=stderr)
+	try:
+		chunk = bytearray()
+		while True:
+			try:
+				chunk += await proc.stdout.readexactly(size - len(chunk))
+			except asyncio.IncompleteReadError as ex:
+				chunk += ex.partial
+				if len(chunk) > keep:
+					yield _to_tensor(chunk[:len(chunk) // SAMPLE_WIDTH * SAMPLE_WIDTH])
+				break
+			yield _to_tensor(chunk)
+			chunk = chunk[len(chunk) - keep:]
+
+		if await proc.wait() != 0:
+			raise RuntimeError(f'Error decoding {path}: {_read_errors(stderr)}')
+	finally:
+		if proc.returncode is None:
+			proc.kill()
+			await proc.wait()
+		stderr.close()
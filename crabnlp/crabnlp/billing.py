@@ -1,23 +1,21 @@
 
 from functools import wraps
 import os
-from typing import Generator, List, Optional, Tuple
-from crabnlp.db import Storage
+from typing import Optional
+from crabnlp.db import open_storage, AsyncStorage
 
 import math
 
-from crabnlp.llms import tlen
+from crabnlp.llms import tlen, llm_user, model_profile, GPT_MODEL_NAME
 
 
 ADMINS = {'bavadim979'}
-GPT_MODEL_NAME = "gpt-3.5-turbo"
-GPT_MAX_CONTEXT_LEN = 4096
-PAGE_SIZE = GPT_MAX_CONTEXT_LEN // 2
 
 
 
 STORAGE_FN = os.environ.get('INFOMAT_BOT_STORAGE', 'data/infomat/users.db')
-db = Storage(STORAGE_FN)
+db = open_storage(STORAGE_FN)
+adb = AsyncStorage(db)
 
 
 def calc_price_cents(text_or_token_count: str | int) -> int:
@@ -31,20 +29,7 @@ def calc_price_cents(text_or_token_count: str | int) -> int:
     else:
         raise RuntimeError(f'Unknown `type(text_or_token_count)` {type(text_or_token_count)}')
 
-    return math.ceil(count / (1000 / 100) * 0.002 * 75 * 3)
-
-def split_by_pages(arr: List[Tuple[str, int]]) -> Generator[List[str], None, None]:
-    batch_cost = 0
-    batch = []
-    for utterance in arr:
-        batch_cost += tlen(utterance['t'])
-        batch.append(utterance)
-
-        if batch_cost > PAGE_SIZE:
-            yield batch
-            batch.clear()
-            batch_cost = 0
-    yield batch
+    return math.ceil(count / (1000 / 100) * model_profile(GPT_MODEL_NAME)['completion_price'] * 75 * 3)
 
 
 class NotEnoughMoney(Exception):
@@ -60,6 +45,11 @@ def create_user_if_needed(tg_id: int, tg_username: str, wellcome_balance: int):
     user = db.get_user(tg_id)
     return user, is_new
 
+async def acreate_user_if_needed(tg_id: int, tg_username: str, wellcome_balance: int):
+    is_new = await adb.create_user_if_needed(tg_id, tg_username, wellcome_balance)
+    user = await adb.get_user(tg_id)
+    return user, is_new
+
 def check_balance(func):
     async def inner(*args, **kwargs):
         user_id = kwargs.get('user_id')
@@ -68,15 +58,27 @@ def check_balance(func):
         if user_id == None or text == None:
             raise ValueError('user_id and text are required for billing transaction')
 
-        user, _ = create_user_if_needed(user_id, user_name, 0)
-        balance = user['balance']
         p = calc_price_cents(text)
-        if balance < p:
-            raise NotEnoughMoney('not enough money for transaction', price=p, balance=balance)
-        else:
+        # the price is reserved under the user lock, so concurrent requests can't spend the same balance twice,
+        # the call itself runs unlocked and the reservation is refunded if it fails
+        async with adb.user_lock(user_id):
+            user, _ = await acreate_user_if_needed(user_id, user_name, 0)
+            balance = user['balance']
+            if balance < p:
+                raise NotEnoughMoney('not enough money for transaction', price=p, balance=balance)
+            if p > 0:
+                await adb.charge_user(user_id, p, 'timecodes')
+        token = llm_user.set(user_id)
+        try:
             res = await func(*args, **kwargs)
-            db.charge_user(user_id, p, 'timecodes')
-            return res, p
+        except BaseException:
+            if p > 0:
+                async with adb.user_lock(user_id):
+                    await adb.topup(user_id, p, 'timecodes refund')
+            raise
+        finally:
+            llm_user.reset(token)
+        return res, p
 
     return inner
 
@@ -93,8 +95,19 @@ def user_balance(user_id, user_name) -> int:
     user, _ = create_user_if_needed(user_id, user_name, 0)
     return user['balance']
 
+async def auser_balance(user_id, user_name) -> int:
+    user, _ = await acreate_user_if_needed(user_id, user_name, 0)
+    return user['balance']
+
 def topup(user_id, cents, reason):
     user = db.get_user(user_id)
     if user == None:
         raise ValueError('User %s not found' % user_id)
     db.topup(user_id, cents, reason)
+
+async def atopup(user_id, cents, reason):
+    async with adb.user_lock(user_id):
+        user = await adb.get_user(user_id)
+        if user == None:
+            raise ValueError('User %s not found' % user_id)
+        await adb.topup(user_id, cents, reason)
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+TRANSCRIPT_CACHE_DIR = os.environ.get('CRABNLP_TRANSCRIPT_CACHE', 'data/cache/transcripts')
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get('CRABNLP_TRANSCRIPT_CACHE_MAX_BYTES', 1024 ** 3))
+COMPLETION_CACHE_DIR = os.environ.get('CRABNLP_COMPLETION_CACHE', 'data/cache/completions')
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get('CRABNLP_COMPLETION_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+COMPLETION_CACHE_MEMORY_ITEMS = int(os.environ.get('CRABNLP_COMPLETION_CACHE_MEMORY_ITEMS', 1024))
+COMPLETION_CACHE_TTL = float(os.environ.get('CRABNLP_COMPLETION_CACHE_TTL', 30 * 24 * 3600))
+
+
+def content_key(*parts) -> str:
+    """Hex digest of strings/bytes, parts are length prefixed so ('ab', 'c') != ('a', 'bc')"""
+    h = hashlib.blake2b(digest_size=20)
+    for p in parts:
+        b = p if isinstance(p, bytes) else str(p).encode()
+        h.update(len(b).to_bytes(8, 'little'))
+        h.update(b)
+    return h.hexdigest()
+
+
+assert content_key('ab', 'c') != content_key('a', 'bc')
+assert content_key('a', b'b') == content_key(b'a', 'b')
+
+
+def file_key(path, *fingerprint) -> str:
+    """Key of a file content and everything else the cached result depends on"""
+    with open(path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'blake2b').hexdigest()
+    return content_key(digest, *fingerprint)
+
+
+class DiskCache:
+    """Pickled values in files named by their keys.
+    When the cache grows over `max_bytes` least recently used files are evicted."""
+    def __init__(self, directory, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _files(self):
+        return [p for p in self.directory.glob('*/*') if p.is_file() and not p.name.startswith('.')]
+
+    def _current_size(self) -> int:
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self._files())
+        return self._size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+    def get(self, key: str, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)  # mtime is the last access time for eviction
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return default
+        with self._lock:
+            self.stats['hits'] += 1
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def set(self, key: str, value):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', delete=False) as f:
+            pickle.dump(value, f)
+        size = os.path.getsize(f.name)
+        with self._lock:
+            current = self._current_size()
+            if path.exists():
+                current -= path.stat().st_size
+            os.replace(f.name, path)
+            self._size = current + size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drops the oldest files until the cache takes 90% of `max_bytes`"""
+        files = []
+        for p in self._files():
+            try:
+                files.append((p.stat().st_mtime, p.stat().st_size, p))
+            except FileNotFoundError:
+                continue
+        self._size = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files, key=lambda f: f[0]):
+            if self._size <= self.max_bytes * 0.9:
+                break
+            p.unlink(missing_ok=True)
+            self._size -= size
+            self.stats['evictions'] += 1
+
+
+class TieredCache:
+    """Bounded in-memory LRU in front of a `DiskCache`, entries expire `ttl` seconds after they are set"""
+    def __init__(self, disk: DiskCache, memory_items: int, ttl: float):
+        self.disk = disk
+        self.memory_items = memory_items
+        self.ttl = ttl
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def _remember(self, key: str, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        tier = 'memory_hits'
+        if entry is None:
+            entry = self.disk.get(key)
+            tier = 'disk_hits'
+        if entry is None or entry[0] < time.time():
+            with self._lock:
+                self._memory.pop(key, None)
+                self.stats['misses'] += 1
+            return default
+        if tier == 'disk_hits':
+            self._remember(key, entry)
+        with self._lock:
+            self.stats[tier] += 1
+        return entry[1]
+
+    def set(self, key: str, value):
+        entry = (time.time() + self.ttl, value)
+        self._remember(key, entry)
+        self.disk.set(key, entry)
+
+
+def completion_key(model: str, temperature, messages) -> str:
+    """Key of a chat completion request, trailing whitespace and line endings in messages are ignored"""
+    normalized = [{'role': m['role'],
+                   'content': '\n'.join(line.rstrip() for line in m['content'].strip().splitlines())}
+                  for m in messages]
+    return content_key('chat', model, temperature, json.dumps(normalized, ensure_ascii=False))
+
+
+assert completion_key('m', 0, [{'role': 'user', 'content': ' a \r\nb\n'}]) == \
+    completion_key('m', 0, [{'role': 'user', 'content': 'a\nb'}])
+assert completion_key('m', 0, [{'role': 'user', 'content': 'a'}]) != \
+    completion_key('m', 1, [{'role': 'user', 'content': 'a'}])
+
+
+transcripts = DiskCache(TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_BYTES)
+completions = TieredCache(DiskCache(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES),
+                          memory_items=COMPLETION_CACHE_MEMORY_ITEMS, ttl=COMPLETION_CACHE_TTL)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as d:
+        c = DiskCache(d, max_bytes=2500)
+        assert c.get('a' * 40) is None
+        c.set('a' * 40, b'x' * 1000)
+        time.sleep(0.01)
+        c.set('b' * 40, b'y' * 1000)
+        assert c.get('a' * 40) == b'x' * 1000
+        time.sleep(0.01)
+        c.set('c' * 40, b'z' * 1000)
+        assert 'b' * 40 not in c
+        assert 'a' * 40 in c and 'c' * 40 in c
+        assert c.stats == {'hits': 1, 'misses': 1, 'evictions': 1}
+
+        t = TieredCache(DiskCache(Path(d) / 't', max_bytes=10000), memory_items=1, ttl=60)
+        t.set('a' * 40, 1)
+        t.set('b' * 40, 2)
+        assert t.get('a' * 40) == 1 and t.get('a' * 40) == 1 and t.get('c' * 40) is None
+        assert t.stats == {'memory_hits': 1, 'disk_hits': 1, 'misses': 1}
+        t.ttl = -1
+        t.set('d' * 40, 3)
+        assert t.get('d' * 40) is None
@@ -4,82 +4,235 @@
 # In[1]:
 
 
+import asyncio
 import dbm
+import functools
 import json
+import os
 import pickle
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Dict, Optional
 
 
 # In[2]:
 
 
+# Transactions of a user are an append-only log split into segments of `LEDGER_SEGMENT_SIZE` entries,
+# a balance change rewrites only the last segment. The balance in the user record is the running sum.
+LEDGER_SEGMENT_SIZE = 256
+STORAGE_USER_CACHE_SIZE = int(os.environ.get('CRABNLP_STORAGE_USER_CACHE', 1024))
+# mailing records of users in a dbm file are indexed by registration day
+DAY = 24 * 3600
+MAILING_PAGE_SIZE = 100
+_FIRST_REGISTRATION_DAY_KEY = 'reg-first-day'
+
+
 def _transaction_key(user_id: int):
+    """The whole list of transactions, as written before the ledger"""
     return f"{user_id}_transactions"
 
 
+def _segment_key(user_id: int, segment: int):
+    return f"{user_id}_transactions_{segment}"
+
+
+def _count_key(user_id: int):
+    return f"{user_id}_transactions_count"
+
+
+def _mailing_key(user_id: int):
+    return f"{user_id}_mailing"
+
+
+def _registration_day_key(day: int):
+    """`user_id -> registered_at` of users registered in the day"""
+    return f"{day}_reg-day"
+
+
+def _ledger_size(db, user_id: int) -> Optional[int]:
+    ck = _count_key(user_id)
+    if ck in db:
+        return int(db[ck])
+    tk = _transaction_key(user_id)
+    if tk in db:
+        return len(json.loads(db[tk]))
+    return None
+
+
+def _read_transactions(db, user_id: int, offset: int = 0, limit: Optional[int] = None) -> Optional[list]:
+    assert offset >= 0
+    size = _ledger_size(db, user_id)
+    if size is None:
+        return None
+    stop = size if limit is None else min(size, offset + limit)
+    if _count_key(user_id) not in db:
+        return json.loads(db[_transaction_key(user_id)])[offset:stop]
+    first = offset // LEDGER_SEGMENT_SIZE
+    transactions = []
+    for segment in range(first, -(-stop // LEDGER_SEGMENT_SIZE)):
+        transactions.extend(json.loads(db[_segment_key(user_id, segment)]))
+    start = offset - first * LEDGER_SEGMENT_SIZE
+    return transactions[start:start + max(stop - offset, 0)]
+
+
+def _upgrade_ledger(db, user_id: int) -> int:
+    """Splits a list written before the ledger into segments, returns the number of transactions"""
+    tk = _transaction_key(user_id)
+    transactions = json.loads(db[tk])
+    for i in range(0, len(transactions), LEDGER_SEGMENT_SIZE):
+        db[_segment_key(user_id, i // LEDGER_SEGMENT_SIZE)] = json.dumps(transactions[i:i + LEDGER_SEGMENT_SIZE])
+    db[_count_key(user_id)] = str(len(transactions))
+    del db[tk]
+    return len(transactions)
+
+
 class Storage:
-    def __init__(self, filename):
+    """Users, their transactions and pickled values in a dbm file.
+    The file is opened on first use and stays open until `close`, so only one process can use it
+    at a time, `SqliteStorage` is for sharing.
+    Every write is synced to disk, writes inside `batch()` are synced once at its end.
+    Up to `cache_users` user records are kept in memory, changes are written through to the file."""
+    def __init__(self, filename, cache_users: int = STORAGE_USER_CACHE_SIZE):
         self.filename = filename
-        with dbm.open(filename, 'c'):
-            pass
+        self.cache_users = cache_users
+        self._db = None
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._users = OrderedDict()
+
+    def _handle(self):
+        if self._db is None:
+            try:
+                # gdbm fast mode: no sync after every write, we sync ourselves
+                self._db = dbm.open(str(self.filename), 'cf')
+            except dbm.error + (ValueError,):
+                self._db = dbm.open(str(self.filename), 'c')
+        return self._db
+
+    def _sync(self):
+        if self._db is not None and hasattr(self._db, 'sync'):
+            self._db.sync()
+
+    @contextmanager
+    def _open(self, write=False):
+        with self._lock:
+            yield self._handle()
+            if write and not self._batch_depth:
+                self._sync()
+
+    @contextmanager
+    def batch(self):
+        """Writes inside the block are synced to disk once, on exit"""
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._sync()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._sync()
+                self._db.close()
+                self._db = None
+            self._users.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _remember(self, key: str, user: dict):
+        self._users[key] = user
+        self._users.move_to_end(key)
+        while len(self._users) > self.cache_users:
+            self._users.popitem(last=False)
 
     def get_user(self, user_id: int):
-        with dbm.open(self.filename) as db:
-            try:
-                bu = db[str(user_id)]
-                return json.loads(bu)
-            except KeyError:
+        key = str(user_id)
+        with self._open() as db:
+            user = self._users.get(key)
+            if user is not None:
+                self._users.move_to_end(key)
+            elif key in db:
+                user = json.loads(db[key])
+                self._remember(key, user)
+            else:
                 return None
+            return dict(user)
 
     def create_user_if_needed(self,
                               tg_id: int,
                               tg_username: str,
                               wellcome_balance: int):
         """Returns `True` if a new user has been created"""
-        u = self.get_user(tg_id)
-        if u:
-            return False
-        with dbm.open(self.filename, 'w') as db:
+        with self._open(write=True) as db:
+            u = self.get_user(tg_id)
+            if u:
+                return False
             u = {'username': tg_username,
                  'balance': wellcome_balance}
             db[str(tg_id)] = json.dumps(u)
+            self._remember(str(tg_id), u)
 
-            tk = _transaction_key(tg_id)
-            assert tk not in db
+            assert _ledger_size(db, tg_id) is None
 
             ts = [
                 {'delta': wellcome_balance,
                  'reason': 'wellcome'}
             ]
-            db[tk] = json.dumps(ts)
+            db[_segment_key(tg_id, 0)] = json.dumps(ts)
+            db[_count_key(tg_id)] = str(len(ts))
 
             return True
 
-    def get_transactions(self, user_id: int):
-        with dbm.open(self.filename) as db:
-            tk = _transaction_key(user_id)
-            try:
-                return json.loads(db[tk])
-            except KeyError:
-                return
+    def get_transactions(self, user_id: int, offset: int = 0, limit: Optional[int] = None):
+        """Transactions from the oldest one, a page reads only the segments it covers"""
+        with self._open() as db:
+            return _read_transactions(db, user_id, offset, limit)
+
+    def count_transactions(self, user_id: int) -> Optional[int]:
+        with self._open() as db:
+            return _ledger_size(db, user_id)
 
     def _change_balance(self,
                        tg_id: int,
                        amount: int,
                        reason: str):
-        user = self.get_user(tg_id)
-        assert user
-        transactions = self.get_transactions(tg_id)
-        assert transactions
-
-        with dbm.open(self.filename, 'w') as db:
-            tk = _transaction_key(tg_id)
+        with self._open(write=True) as db:
+            user = self.get_user(tg_id)
+            assert user
+            size = _ledger_size(db, tg_id)
+            assert size
+            if _count_key(tg_id) not in db:
+                size = _upgrade_ledger(db, tg_id)
+
+            sk = _segment_key(tg_id, size // LEDGER_SEGMENT_SIZE)
+            segment = json.loads(db[sk]) if size % LEDGER_SEGMENT_SIZE else []
             tr = {'delta': amount,
                   'reason': reason}
-            transactions.append(tr)
-            db[tk] = json.dumps(transactions)
+            segment.append(tr)
+            db[sk] = json.dumps(segment)
+            db[_count_key(tg_id)] = str(size + 1)
 
             user['balance'] += amount
             db[str(tg_id)] = json.dumps(user)
+            self._remember(str(tg_id), user)
 
     def charge_user(self,
                     tg_id: int,
@@ -97,7 +250,7 @@ class Storage:
 
     def get_value(self, key, default=None, decode=pickle.loads):
         k = str(key)
-        with dbm.open(self.filename) as db:
+        with self._open() as db:
             if k in db:
                 return decode(db[k])
             else:
@@ -106,7 +259,7 @@ class Storage:
     def set_value(self, key, value, encode=pickle.dumps):
         k = str(key)
         v = encode(value)
-        with dbm.open(self.filename, 'w') as db:
+        with self._open(write=True) as db:
             db[k] = v
 
     def __getitem__(self, key):
@@ -115,6 +268,355 @@ class Storage:
     def __setitem__(self, key, value):
         return self.set_value(key, value)
 
+    def __iter__(self):
+        with self._open() as db:
+            keys = db.keys()
+        return (k.decode() if isinstance(k, bytes) else k for k in keys)
+
+    def register_mailing_user(self, user_id: int, registered_at: float):
+        """Creates the mailing record of a user and adds the user to the bucket of the registration day"""
+        info = {'user_id': int(user_id),
+                'registered_at': registered_at,
+                'mailing_set': set()}
+        day = int(registered_at // DAY)
+        with self.batch():
+            self[_mailing_key(user_id)] = info
+            bucket = self.get_value(_registration_day_key(day), {})
+            bucket[int(user_id)] = registered_at
+            self[_registration_day_key(day)] = bucket
+            first_day = self[_FIRST_REGISTRATION_DAY_KEY]
+            if first_day is None or day < first_day:
+                self[_FIRST_REGISTRATION_DAY_KEY] = day
+
+    def get_mailing_user(self, user_id: int) -> Optional[dict]:
+        return self[_mailing_key(user_id)]
+
+    def add_mailing(self, user_id: int, mailing: str):
+        with self.batch():
+            info = self.get_mailing_user(user_id)
+            assert info, f'User {user_id} is not registered'
+            info['mailing_set'].add(mailing)
+            self[_mailing_key(user_id)] = info
+
+    def find_mailing_users(self, registered_from: float, registered_to: float, lacking: Optional[str] = None,
+                           after: Optional[tuple] = None, limit: int = MAILING_PAGE_SIZE):
+        """Reads only the days of the range and records of their users"""
+        first_day = self[_FIRST_REGISTRATION_DAY_KEY]
+        if first_day is None:
+            return [], None
+        start = max(registered_from, after[0]) if after else registered_from
+        page = []
+        for day in range(max(first_day, int(start // DAY)), int(min(registered_to, time()) // DAY) + 1):
+            bucket = self.get_value(_registration_day_key(day), {})
+            for user_id, registered_at in sorted(bucket.items(), key=lambda e: (e[1], e[0])):
+                if not registered_from <= registered_at < registered_to or (after and (registered_at, user_id) <= tuple(after)):
+                    continue
+                info = self.get_mailing_user(user_id)
+                # a user registered again is indexed under the latest registration only
+                if info is None or info['registered_at'] != registered_at or lacking in info['mailing_set']:
+                    continue
+                page.append(info)
+                if len(page) == limit:
+                    return page, (registered_at, user_id)
+        return page, None
+
+
+# In[ ]:
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    balance INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    delta INTEGER NOT NULL,
+    reason TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_by_user ON transactions(user_id, id);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mailing_users (
+    user_id INTEGER PRIMARY KEY,
+    registered_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mailing_users_by_registration ON mailing_users(registered_at, user_id);
+CREATE TABLE IF NOT EXISTS mailings (
+    user_id INTEGER NOT NULL REFERENCES mailing_users(user_id),
+    mailing TEXT NOT NULL,
+    PRIMARY KEY (user_id, mailing)
+);
+"""
+
+
+def _insert_mailing_user(conn: sqlite3.Connection, info: dict):
+    conn.execute('INSERT OR REPLACE INTO mailing_users (user_id, registered_at) VALUES (?, ?)',
+                 (int(info['user_id']), info['registered_at']))
+    conn.execute('DELETE FROM mailings WHERE user_id = ?', (int(info['user_id']),))
+    conn.executemany('INSERT INTO mailings (user_id, mailing) VALUES (?, ?)',
+                     [(int(info['user_id']), m) for m in info['mailing_set']])
+
+
+class SqliteStorage:
+    """`Storage` on SQLite in WAL mode: a balance change is one UPDATE plus an appended transaction
+    in a single database transaction, so several bot processes can share the file.
+    Every thread gets its own connection."""
+    def __init__(self, filename, timeout=30):
+        self.filename = str(filename)
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SQLITE_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def get_user(self, user_id: int):
+        row = self._conn().execute('SELECT username, balance FROM users WHERE id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        return {'username': row[0], 'balance': row[1]}
+
+    def create_user_if_needed(self,
+                              tg_id: int,
+                              tg_username: str,
+                              wellcome_balance: int):
+        """Returns `True` if a new user has been created"""
+        with self._transaction() as conn:
+            created = conn.execute('INSERT OR IGNORE INTO users (id, username, balance) VALUES (?, ?, ?)',
+                                   (tg_id, tg_username, wellcome_balance)).rowcount == 1
+            if created:
+                conn.execute('INSERT INTO transactions (user_id, delta, reason, created_at) VALUES (?, ?, ?, ?)',
+                             (tg_id, wellcome_balance, 'wellcome', time()))
+        return created
+
+    def get_transactions(self, user_id: int, offset: int = 0, limit: Optional[int] = None):
+        """Transactions from the oldest one, pages are read through the (user_id, id) index"""
+        assert offset >= 0
+        if self.get_user(user_id) is None:
+            return
+        rows = self._conn().execute('SELECT delta, reason FROM transactions WHERE user_id = ? ORDER BY id '
+                                    'LIMIT ? OFFSET ?', (user_id, -1 if limit is None else limit, offset))
+        return [{'delta': delta, 'reason': reason} for delta, reason in rows]
+
+    def count_transactions(self, user_id: int) -> Optional[int]:
+        if self.get_user(user_id) is None:
+            return
+        return self._conn().execute('SELECT COUNT(*) FROM transactions WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def _change_balance(self,
+                        tg_id: int,
+                        amount: int,
+                        reason: str):
+        with self._transaction() as conn:
+            updated = conn.execute('UPDATE users SET balance = balance + ? WHERE id = ?', (amount, tg_id)).rowcount
+            assert updated == 1, f'User {tg_id} not found'
+            conn.execute('INSERT INTO transactions (user_id, delta, reason, created_at) VALUES (?, ?, ?, ?)',
+                         (tg_id, amount, reason, time()))
+
+    def charge_user(self,
+                    tg_id: int,
+                    amount: int,
+                    reason: str):
+        assert amount > 0
+        self._change_balance(tg_id, -amount, reason)
+
+    def topup(self,
+              tg_id: int,
+              amount: int,
+              reason: str):
+        assert amount > 0
+        self._change_balance(tg_id, amount, reason)
+
+    def get_value(self, key, default=None, decode=pickle.loads):
+        row = self._conn().execute('SELECT value FROM kv WHERE key = ?', (str(key),)).fetchone()
+        return default if row is None else decode(row[0])
+
+    def set_value(self, key, value, encode=pickle.dumps):
+        self._conn().execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (str(key), encode(value)))
+
+    def __getitem__(self, key):
+        return self.get_value(key)
+
+    def __setitem__(self, key, value):
+        return self.set_value(key, value)
+
+    def __iter__(self):
+        """Keys of values, users and transactions aren't included"""
+        return (key for key, in self._conn().execute('SELECT key FROM kv').fetchall())
+
+    def register_mailing_user(self, user_id: int, registered_at: float):
+        with self._transaction() as conn:
+            _insert_mailing_user(conn, {'user_id': user_id, 'registered_at': registered_at, 'mailing_set': ()})
+
+    def _mailing_sets(self, user_ids) -> Dict[int, set]:
+        user_ids = list(user_ids)
+        sets = {user_id: set() for user_id in user_ids}
+        rows = self._conn().execute(f'SELECT user_id, mailing FROM mailings WHERE user_id IN '
+                                    f'({", ".join("?" * len(user_ids))})', user_ids)
+        for user_id, mailing in rows:
+            sets[user_id].add(mailing)
+        return sets
+
+    def get_mailing_user(self, user_id: int) -> Optional[dict]:
+        row = self._conn().execute('SELECT registered_at FROM mailing_users WHERE user_id = ?',
+                                   (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        return {'user_id': int(user_id),
+                'registered_at': row[0],
+                'mailing_set': self._mailing_sets([int(user_id)])[int(user_id)]}
+
+    def add_mailing(self, user_id: int, mailing: str):
+        with self._transaction() as conn:
+            registered = conn.execute('SELECT 1 FROM mailing_users WHERE user_id = ?', (int(user_id),)).fetchone()
+            assert registered, f'User {user_id} is not registered'
+            conn.execute('INSERT OR IGNORE INTO mailings (user_id, mailing) VALUES (?, ?)', (int(user_id), mailing))
+
+    def find_mailing_users(self, registered_from: float, registered_to: float, lacking: Optional[str] = None,
+                           after: Optional[tuple] = None, limit: int = MAILING_PAGE_SIZE):
+        """A range scan of the (registered_at, user_id) index"""
+        query = 'SELECT user_id, registered_at FROM mailing_users u WHERE registered_at >= ? AND registered_at < ?'
+        params = [registered_from, registered_to]
+        if after:
+            query += ' AND (registered_at, user_id) > (?, ?)'
+            params += list(after)
+        if lacking is not None:
+            query += ' AND NOT EXISTS (SELECT 1 FROM mailings m WHERE m.user_id = u.user_id AND m.mailing = ?)'
+            params.append(lacking)
+        rows = self._conn().execute(query + ' ORDER BY registered_at, user_id LIMIT ?', params + [limit]).fetchall()
+        sets = self._mailing_sets(user_id for user_id, _ in rows)
+        page = [{'user_id': user_id, 'registered_at': registered_at, 'mailing_set': sets[user_id]}
+                for user_id, registered_at in rows]
+        return page, ((rows[-1][1], rows[-1][0]) if len(rows) == limit else None)
+
+
+def migrate_dbm_to_sqlite(dbm_filename, sqlite_filename) -> SqliteStorage:
+    """Copies users, their transactions and values of a `Storage` file. Running it again overwrites
+    what the previous run copied, so it can be repeated right before switching over"""
+    target = SqliteStorage(sqlite_filename)
+    with dbm.open(str(dbm_filename), 'r') as db, target._transaction() as conn:
+        keys = {k.decode() if isinstance(k, bytes) else k for k in db.keys()}
+        for key in keys:
+            value = db[key]
+            if key.isdigit() and _ledger_size(db, key) is not None and not value.startswith(b'\x80'):
+                user = json.loads(value)
+                conn.execute('INSERT OR REPLACE INTO users (id, username, balance) VALUES (?, ?, ?)',
+                             (int(key), user['username'], user['balance']))
+                conn.execute('DELETE FROM transactions WHERE user_id = ?', (int(key),))
+                conn.executemany('INSERT INTO transactions (user_id, delta, reason, created_at) VALUES (?, ?, ?, ?)',
+                                 [(int(key), t['delta'], t['reason'], 0) for t in _read_transactions(db, key)])
+            elif '_transactions' in key and key.split('_', 1)[0] in keys:
+                continue
+            elif key == _mailing_key(key.split('_', 1)[0]) and key.split('_', 1)[0].isdigit():
+                _insert_mailing_user(conn, pickle.loads(value))
+            elif key == _FIRST_REGISTRATION_DAY_KEY or key == _registration_day_key(key.split('_', 1)[0]):
+                continue
+            else:
+                conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+    return target
+
+
+def open_storage(filename):
+    """`SqliteStorage` for *.sqlite / *.sqlite3 files, dbm based `Storage` otherwise"""
+    if Path(filename).suffix in ('.sqlite', '.sqlite3'):
+        return SqliteStorage(filename)
+    return Storage(filename)
+
+
+# In[ ]:
+
+
+class AsyncStorage:
+    """Runs methods of a storage in its own thread, so disk stalls don't freeze the event loop.
+    Calls are executed one by one, `user_lock` serializes coroutines working with the same user."""
+    def __init__(self, storage):
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self._user_locks = weakref.WeakValueDictionary()
+
+    async def _run(self, method: str, *args, **kwargs):
+        call = functools.partial(getattr(self.storage, method), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def user_lock(self, user_id) -> asyncio.Lock:
+        """Held around a read-check-write of a user, e.g. a balance check and the following charge"""
+        key = str(user_id)
+        lock = self._user_locks.get(key)
+        if lock is None:
+            lock = self._user_locks[key] = asyncio.Lock()
+        return lock
+
+    async def get_user(self, user_id: int):
+        return await self._run('get_user', user_id)
+
+    async def create_user_if_needed(self, tg_id: int, tg_username: str, wellcome_balance: int):
+        return await self._run('create_user_if_needed', tg_id, tg_username, wellcome_balance)
+
+    async def get_transactions(self, user_id: int, offset: int = 0, limit: Optional[int] = None):
+        return await self._run('get_transactions', user_id, offset, limit)
+
+    async def count_transactions(self, user_id: int):
+        return await self._run('count_transactions', user_id)
+
+    async def charge_user(self, tg_id: int, amount: int, reason: str):
+        return await self._run('charge_user', tg_id, amount, reason)
+
+    async def topup(self, tg_id: int, amount: int, reason: str):
+        return await self._run('topup', tg_id, amount, reason)
+
+    async def get_value(self, key, default=None, **kwargs):
+        return await self._run('get_value', key, default, **kwargs)
+
+    async def set_value(self, key, value, **kwargs):
+        return await self._run('set_value', key, value, **kwargs)
+
+    async def register_mailing_user(self, user_id: int, registered_at: float):
+        return await self._run('register_mailing_user', user_id, registered_at)
+
+    async def get_mailing_user(self, user_id: int):
+        return await self._run('get_mailing_user', user_id)
+
+    async def add_mailing(self, user_id: int, mailing: str):
+        return await self._run('add_mailing', user_id, mailing)
+
+    async def find_mailing_users(self, registered_from: float, registered_to: float, lacking: Optional[str] = None,
+                                 after: Optional[tuple] = None, limit: int = MAILING_PAGE_SIZE):
+        return await self._run('find_mailing_users', registered_from, registered_to, lacking, after, limit)
+
+    async def close(self):
+        await self._run('close')
+        self._executor.shutdown()
+
 
 # In[6]:
 
@@ -122,40 +624,112 @@ class Storage:
 if __name__ == '__main__':
     import tempfile
     import random
-    from pathlib import Path
     import glob
     import os
 
     fn = Path(tempfile.gettempdir()) / f"dbm-test-{random.randint(100000000, 900000000)}"
 
     try:
-        s = Storage(fn)
-
-        assert not s.get_user(100)
-        assert s.create_user_if_needed(100, 'tester', 100 * 100)
-        assert s.get_user(100) == {'username': 'tester', 'balance': 10000}
-        assert s.get_transactions(100) == [{'delta': 10000, 'reason': 'wellcome'}]
-
-        s.charge_user(100, 99, 'spent')
-        assert s.get_user(100) == {'username': 'tester', 'balance': 9901}
-        s.topup(100, 22222, 'paid')
-        assert s.get_user(100) == {'username': 'tester', 'balance': 32123}
-        assert s.get_transactions(100) == [
-            {'delta': 10000, 'reason': 'wellcome'},
-            {'delta': -99, 'reason': 'spent'},
-            {'delta': 22222, 'reason': 'paid'}]
-
-        s.set_value(1234, '67890')
-        assert s.get_value(1234, '67890')
-
-        s.set_value('dict', {'hello': 'there'})
-        assert s.get_value('dict') == {'hello': 'there'}
-
-        s.set_value('333', [1, 2, {6, 7}, '7'])
-        assert s.get_value(333) == [1, 2, {6, 7}, '7']
-
-        s[444] = {'j': 'k', 'l': [1, 2, 3]}
-        assert s[444] == {'j': 'k', 'l': [1, 2, 3]}
+        for s in (Storage(fn), SqliteStorage(f'{fn}.sqlite')):
+            assert not s.get_user(100)
+            assert s.create_user_if_needed(100, 'tester', 100 * 100)
+            assert not s.create_user_if_needed(100, 'tester', 100 * 100)
+            assert s.get_user(100) == {'username': 'tester', 'balance': 10000}
+            assert s.get_transactions(100) == [{'delta': 10000, 'reason': 'wellcome'}]
+
+            s.charge_user(100, 99, 'spent')
+            assert s.get_user(100) == {'username': 'tester', 'balance': 9901}
+            s.topup(100, 22222, 'paid')
+            assert s.get_user(100) == {'username': 'tester', 'balance': 32123}
+            assert s.get_transactions(100) == [
+                {'delta': 10000, 'reason': 'wellcome'},
+                {'delta': -99, 'reason': 'spent'},
+                {'delta': 22222, 'reason': 'paid'}]
+
+            s.set_value(1234, '67890')
+            assert s.get_value(1234, '67890')
+
+            s.set_value('dict', {'hello': 'there'})
+            assert s.get_value('dict') == {'hello': 'there'}
+
+            s.set_value('333', [1, 2, {6, 7}, '7'])
+            assert s.get_value(333) == [1, 2, {6, 7}, '7']
+
+            s[444] = {'j': 'k', 'l': [1, 2, 3]}
+            assert s[444] == {'j': 'k', 'l': [1, 2, 3]}
+            assert {'1234', 'dict', '333', '444'} <= set(s)
+
+            for i in range(LEDGER_SEGMENT_SIZE * 2):
+                s.charge_user(100, 1, f'call {i}')
+            assert s.get_user(100)['balance'] == 32123 - LEDGER_SEGMENT_SIZE * 2
+            assert s.count_transactions(100) == 3 + LEDGER_SEGMENT_SIZE * 2
+            assert len(s.get_transactions(100)) == 3 + LEDGER_SEGMENT_SIZE * 2
+            page = s.get_transactions(100, offset=LEDGER_SEGMENT_SIZE - 2, limit=5)
+            assert [t['reason'] for t in page] == [f'call {i}' for i in range(LEDGER_SEGMENT_SIZE - 5, LEDGER_SEGMENT_SIZE)]
+            assert s.get_transactions(100, offset=1, limit=2) == [{'delta': -99, 'reason': 'spent'},
+                                                                  {'delta': 22222, 'reason': 'paid'}]
+            assert s.get_transactions(100, offset=10 ** 6) == []
+            assert s.get_transactions(101) is None and s.count_transactions(101) is None
+
+            s.register_mailing_user(7, 1000.0)
+            s.register_mailing_user(8, 2000.0)
+            s.add_mailing(7, 'tips')
+            assert s.get_mailing_user(7) == {'user_id': 7, 'registered_at': 1000.0, 'mailing_set': {'tips'}}
+            assert s.find_mailing_users(0, 3000, lacking='tips') == (
+                [{'user_id': 8, 'registered_at': 2000.0, 'mailing_set': set()}], None)
+            s.close()
+
+        for _ in range(2):
+            m = migrate_dbm_to_sqlite(fn, f'{fn}-migrated.sqlite')
+            assert m.get_user(100) == {'username': 'tester', 'balance': 32123 - LEDGER_SEGMENT_SIZE * 2}
+            with Storage(fn) as src:
+                assert m.get_transactions(100) == src.get_transactions(100)
+            assert m[444] == {'j': 'k', 'l': [1, 2, 3]} and m.get_value(1234) == '67890'
+            assert set(m) == {'1234', 'dict', '333', '444'}
+            assert [u['user_id'] for u in m.find_mailing_users(0, 3000, limit=1)[0]] == [7]
+            assert m.get_mailing_user(7)['mailing_set'] == {'tips'}
+
+        # a list written before the ledger is read as is and split into segments on the next change
+        with dbm.open(str(fn), 'w') as db:
+            db['200'] = json.dumps({'username': 'old', 'balance': 5})
+            db[_transaction_key(200)] = json.dumps([{'delta': 5, 'reason': 'wellcome'}])
+        with Storage(fn) as old:
+            assert old.get_transactions(200) == [{'delta': 5, 'reason': 'wellcome'}]
+            old.topup(200, 3, 'paid')
+            assert old.get_transactions(200, offset=1) == [{'delta': 3, 'reason': 'paid'}]
+            assert old.get_user(200)['balance'] == 8 and old.count_transactions(200) == 2
+
+        # cached users are bounded, copies and written through
+        with Storage(f'{fn}-cache', cache_users=2) as s:
+            # importing a module with a storage doesn't open (and lock) its file
+            assert s._db is None and not glob.glob(f'{fn}-cache*')
+            with s.batch():
+                for user_id in range(3):
+                    s.create_user_if_needed(user_id, f'u{user_id}', 10)
+            assert list(s._users) == ['1', '2']
+            s.get_user(1)['balance'] = 0
+            s.charge_user(1, 4, 'spent')
+            assert s.get_user(1)['balance'] == 6
+        with Storage(f'{fn}-cache') as s:
+            assert [s.get_user(user_id)['balance'] for user_id in range(3)] == [10, 6, 10]
+
+        async def _spend(a: AsyncStorage, user_id, price):
+            async with a.user_lock(user_id):
+                user = await a.get_user(user_id)
+                await asyncio.sleep(0)
+                if user['balance'] >= price:
+                    await a.charge_user(user_id, price, 'spent')
+
+        async def _check_async():
+            a = AsyncStorage(Storage(f'{fn}-async'))
+            assert await a.create_user_if_needed(1, 'u1', 10)
+            await asyncio.gather(*[_spend(a, 1, 3) for _ in range(5)])
+            assert (await a.get_user(1))['balance'] == 1 and await a.count_transactions(1) == 4
+            await a.set_value('k', {1})
+            assert await a.get_value('k') == {1}
+            await a.close()
+
+        asyncio.run(_check_async())
     finally:
         for ff in glob.glob(str(fn) + '*'):
             os.remove(ff)
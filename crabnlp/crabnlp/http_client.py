@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+import os
+import weakref
+
+import aiohttp
+
+
+HTTP_LIMIT = int(os.environ.get('CRABNLP_HTTP_LIMIT', 100))
+HTTP_LIMIT_PER_HOST = int(os.environ.get('CRABNLP_HTTP_LIMIT_PER_HOST', 20))
+HTTP_DNS_TTL = int(os.environ.get('CRABNLP_HTTP_DNS_TTL', 300))
+HTTP_KEEPALIVE = float(os.environ.get('CRABNLP_HTTP_KEEPALIVE', 30))
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=float(os.environ.get('CRABNLP_HTTP_TIMEOUT', 120)),
+                                     sock_connect=10)
+
+# a session is bound to the event loop it was created in
+_sessions: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]' = weakref.WeakKeyDictionary()
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Process wide session: pooled keep-alive connections, cached DNS, per host limits.
+    Don't close it, use `close` on shutdown"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT,
+                                         limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=HTTP_DNS_TTL,
+                                         keepalive_timeout=HTTP_KEEPALIVE)
+        session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+        _sessions[loop] = session
+    return session
+
+
+async def close():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+if __name__ == '__main__':
+    async def _check():
+        assert get_session() is get_session()
+        await close()
+        assert get_session() is not None and not get_session().closed
+        await close()
+
+    asyncio.run(_check())
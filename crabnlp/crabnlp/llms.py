@@ -5,37 +5,157 @@
 
 
 import os
+import hashlib
+import threading
 import functools
-from time import monotonic
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+from time import monotonic, sleep
 import asyncio
-from typing import Optional, List, Callable
+import json
+from typing import Optional, List, Dict, Callable, AsyncGenerator, AsyncIterable, Generator, Tuple, TypedDict
 
 import tiktoken
 import openai
-from openai.error import RateLimitError
+from openai.error import RateLimitError, APIError
+
+from crabnlp import cache
+from crabnlp.http_client import get_session
 
 
 # In[2]:
 
 
-GPT_MODEL_NAME = "gpt-3.5-turbo"
-GPT_MAX_CONTEXT_LEN = 4096
-tok = tiktoken.encoding_for_model(GPT_MODEL_NAME)
+class ModelProfile(TypedDict):
+    context: int             # prompt and answer tokens together
+    prompt_price: float      # USD per 1K tokens
+    completion_price: float
+    encoding: str
+    tokens_per_message: int  # chat markup around every message
+    tokens_per_name: int
+
+
+MODEL_PROFILES: Dict[str, ModelProfile] = {
+    'gpt-3.5-turbo': ModelProfile(context=4096, prompt_price=0.002, completion_price=0.002,
+                                  encoding='cl100k_base', tokens_per_message=3, tokens_per_name=1),
+    'gpt-3.5-turbo-0301': ModelProfile(context=4096, prompt_price=0.002, completion_price=0.002,
+                                       encoding='cl100k_base', tokens_per_message=4, tokens_per_name=-1),
+    'gpt-3.5-turbo-16k': ModelProfile(context=16384, prompt_price=0.003, completion_price=0.004,
+                                      encoding='cl100k_base', tokens_per_message=3, tokens_per_name=1),
+    'gpt-4': ModelProfile(context=8192, prompt_price=0.03, completion_price=0.06,
+                          encoding='cl100k_base', tokens_per_message=3, tokens_per_name=1),
+    'gpt-4-32k': ModelProfile(context=32768, prompt_price=0.06, completion_price=0.12,
+                              encoding='cl100k_base', tokens_per_message=3, tokens_per_name=1),
+    'text-embedding-ada-002': ModelProfile(context=8191, prompt_price=0.0001, completion_price=0,
+                                           encoding='cl100k_base', tokens_per_message=0, tokens_per_name=0),
+}
+
+
+def model_profile(model_name: str) -> ModelProfile:
+    """Profile of the model or of its family, e.g. `gpt-4-0613` is `gpt-4`"""
+    for name in sorted(MODEL_PROFILES, key=len, reverse=True):
+        if model_name == name or model_name.startswith(name + '-'):
+            return MODEL_PROFILES[name]
+    raise ValueError(f'Unknown model `{model_name}`, add it to `MODEL_PROFILES`')
+
+
+assert model_profile('gpt-4-0613') is MODEL_PROFILES['gpt-4']
+assert model_profile('gpt-4-32k-0613') is MODEL_PROFILES['gpt-4-32k']
+
+
+GPT_MODEL_NAME = os.environ.get('CRABNLP_GPT_MODEL', "gpt-3.5-turbo")
+GPT_MAX_CONTEXT_LEN = model_profile(GPT_MODEL_NAME)['context']
+# all profiles share one encoding, token counts below are cached without the model name
+tok = tiktoken.get_encoding(model_profile(GPT_MODEL_NAME)['encoding'])
 openai.api_key = os.environ['OPENAI']
 
 
 # In[3]:
 
 
+TOKEN_CACHE_MAX_TOKENS = int(os.environ.get('CRABNLP_TOKEN_CACHE_MAX_TOKENS', 1_000_000))
+TOKENIZER_THREADS = int(os.environ.get('CRABNLP_TOKENIZER_THREADS', os.cpu_count() or 1))
+
+_token_cache: 'OrderedDict[bytes, List[int]]' = OrderedDict()
+_token_cache_size = 0
+_token_cache_lock = threading.Lock()
+# per entry bookkeeping, in tokens, so that many short lines don't outgrow the budget
+_TOKEN_CACHE_ENTRY_COST = 8
+token_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def _cache_get(key: bytes) -> Optional[List[int]]:
+    with _token_cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is None:
+            token_cache_stats['misses'] += 1
+        else:
+            _token_cache.move_to_end(key)
+            token_cache_stats['hits'] += 1
+        return tokens
+
+
+def _cache_put(key: bytes, tokens: List[int]):
+    global _token_cache_size
+    if len(tokens) > TOKEN_CACHE_MAX_TOKENS:
+        return
+    with _token_cache_lock:
+        if key in _token_cache:
+            return
+        _token_cache[key] = tokens
+        _token_cache_size += len(tokens) + _TOKEN_CACHE_ENTRY_COST
+        while _token_cache_size > TOKEN_CACHE_MAX_TOKENS:
+            _, evicted = _token_cache.popitem(last=False)
+            _token_cache_size -= len(evicted) + _TOKEN_CACHE_ENTRY_COST
+
+
+def encode(text: str) -> List[int]:
+    """Tokens of `text`, LRU cached by text hash. The result is shared, don't mutate it"""
+    key = _text_key(text)
+    tokens = _cache_get(key)
+    if tokens is None:
+        tokens = tok.encode(text)
+        _cache_put(key, tokens)
+    return tokens
+
+
+def encode_many(texts: List[str]) -> List[List[int]]:
+    """Batched `encode`, cache misses are encoded in one multithreaded tiktoken call"""
+    texts = list(texts)
+    keys = [_text_key(t) for t in texts]
+    result = [_cache_get(k) for k in keys]
+    missing = [i for i, tokens in enumerate(result) if tokens is None]
+    if missing:
+        encoded = tok.encode_batch([texts[i] for i in missing], num_threads=TOKENIZER_THREADS)
+        for i, tokens in zip(missing, encoded):
+            result[i] = tokens
+            _cache_put(keys[i], tokens)
+    return result
+
+
 def tlen(text: str) -> int:
-    return len(tok.encode(text))
+    return len(encode(text))
+
+
+def tlen_many(texts: List[str]) -> List[int]:
+    return [len(t) for t in encode_many(texts)]
 
 
 # In[4]:
 
 
-def calc_overhead(messages):
-    return int(tlen(repr(messages)) * 1.1)
+def calc_overhead(messages, model_name=None):
+    """Exact prompt tokens of chat `messages`, including the markup of every message and the reply priming"""
+    profile = model_profile(model_name or GPT_MODEL_NAME)
+    values = [v for m in messages for v in m.values()]
+    names = sum(1 for m in messages if 'name' in m)
+    return (sum(tlen_many(values)) + profile['tokens_per_message'] * len(messages)
+            + profile['tokens_per_name'] * names + 3)
 
 
 # In[5]:
@@ -46,7 +166,7 @@ def chunk_a_text(text: str, max_tokens: int, overlapping: Optional[int | float]
         overlapping = int(max_tokens/10)
     elif isinstance(overlapping, float):
         overlapping = int(max_tokens * overlapping)
-    t = tok.encode(text)
+    t = encode(text)
     for i in range(0, len(t), max_tokens-overlapping):
         yield tok.decode(t[i:(i+max_tokens)]).strip()
 
@@ -55,24 +175,75 @@ assert list(chunk_a_text("1 2 3 4 5 6 7 8 9 10", 8, 4)) == \
         ['1 2 3 4', '3 4 5 6', '5 6 7 8', '7 8 9 10', '9 10']
 
 
-def chunk_texts(lines: List[str], max_tokens=GPT_MAX_CONTEXT_LEN-256, join_lines_char=''):
+def chunk_texts(lines: List[str], max_tokens=GPT_MAX_CONTEXT_LEN-256, join_lines_char='',
+                overlapping: int | float = 0):
     """Chunk a list of lines, try minimazing spliting a line 
-    (for instance, every line is a sentence)"""
+    (for instance, every line is a sentence).
+    Every line is tokenized once and packed in a single pass,
+    the last `overlapping` tokens worth of lines are repeated in the next chunk"""
     if not lines:
         return
-    for i in range(len(lines), 1, -1):
-        if tlen(join_lines_char.join(lines[:i])) <= max_tokens:
-            yield join_lines_char.join(lines[:i])
-            yield from chunk_texts(lines[max(i, 0):], max_tokens=max_tokens, join_lines_char=join_lines_char)
-            break
+    if isinstance(overlapping, float):
+        overlapping = int(max_tokens * overlapping)
+    first_lens = tlen_many(lines)
+    if join_lines_char:
+        joined_lens = tlen_many([join_lines_char + l for l in lines])
     else:
-        yield from chunk_a_text(lines[0], max_tokens=max_tokens)
-        yield from chunk_texts(lines[1:], max_tokens=max_tokens, join_lines_char=join_lines_char)
+        joined_lens = first_lens
+
+    def size(chunk):
+        return first_lens[chunk[0]] + sum(joined_lens[j] for j in chunk[1:])
+
+    chunk, chunk_len = [], 0
+    for i, line in enumerate(lines):
+        if chunk and chunk_len + joined_lens[i] > max_tokens:
+            yield join_lines_char.join(lines[j] for j in chunk)
+            tail, tail_len = [], 0
+            for j in reversed(chunk):
+                if tail_len + joined_lens[j] > overlapping:
+                    break
+                tail.insert(0, j)
+                tail_len += joined_lens[j]
+            chunk = tail
+            while chunk and size(chunk) + joined_lens[i] > max_tokens:
+                chunk.pop(0)
+            chunk_len = size(chunk) if chunk else 0
+        if not chunk and first_lens[i] > max_tokens:
+            yield from chunk_a_text(line, max_tokens=max_tokens)
+            continue
+        chunk_len += joined_lens[i] if chunk else first_lens[i]
+        chunk.append(i)
+    if chunk:
+        yield join_lines_char.join(lines[j] for j in chunk)
 
 
 assert list(chunk_texts(['hello world!', 'one two three'], 2)) == ['hello world', '!', 'one two', 'three']
 assert list(chunk_texts(['one two three', 'four five six', 'seven eight nine ten'], 6, join_lines_char=' ')) \
  == ['one two three four five six', 'seven eight nine ten']
+assert list(chunk_texts(['one two', 'three four', 'five six'], 4, join_lines_char=' ', overlapping=2)) \
+ == ['one two three four', 'three four five six']
+
+
+# In[ ]:
+
+
+PAGE_SIZE = GPT_MAX_CONTEXT_LEN // 2
+
+
+def split_by_pages(arr: List[Tuple[str, int]]) -> Generator[List[str], None, None]:
+    arr = list(arr)
+    costs = tlen_many([utterance['t'] for utterance in arr])
+    batch_cost = 0
+    batch = []
+    for utterance, cost in zip(arr, costs):
+        batch_cost += cost
+        batch.append(utterance)
+
+        if batch_cost > PAGE_SIZE:
+            yield batch
+            batch.clear()
+            batch_cost = 0
+    yield batch
 
 
 # In[6]:
@@ -103,25 +274,282 @@ def backoff(*exceptions, max_wait_sec=60, start=1, base=1.5):
     return wrapper
 
 
+# In[ ]:
+
+
+OPENAI_RPM = int(os.environ.get('CRABNLP_OPENAI_RPM', 3500))
+OPENAI_TPM = int(os.environ.get('CRABNLP_OPENAI_TPM', 90000))
+OPENAI_MAX_IN_FLIGHT = int(os.environ.get('CRABNLP_OPENAI_MAX_IN_FLIGHT', 16))
+# completion tokens assumed for a request until the response reports the real usage
+ANSWER_TOKENS_ESTIMATE = 512
+
+# the user on whose behalf OpenAI is called, used for fair queueing when not passed explicitly
+llm_user = contextvars.ContextVar('llm_user', default=None)
+
+
+def estimate_tokens(messages, max_tokens: Optional[int] = None, model_name=None) -> int:
+    return calc_overhead(messages, model_name) + (max_tokens or ANSWER_TOKENS_ESTIMATE)
+
+
+class RateLimiter:
+    """Client side scheduler for OpenAI calls.
+
+    Requests and tokens per minute are token buckets, at most `max_in_flight` calls run at once
+    and waiting requests are served round robin across users."""
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM, max_in_flight=OPENAI_MAX_IN_FLIGHT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_in_flight = max_in_flight
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._refilled = monotonic()
+        self._in_flight = 0
+        self._queues: 'OrderedDict[object, deque]' = OrderedDict()
+        self._timer = None
+        self._timer_loop = None
+        self._loop = None
+        # the budget is shared with `blocking_slot` callers in worker threads
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed, self._refilled = now - self._refilled, now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            self._dispatch_locked()
+
+    def _dispatch_locked(self):
+        self._refill()
+        while self._queues and self._in_flight < self.max_in_flight:
+            user, queue = next(iter(self._queues.items()))
+            tokens, fut = queue[0]
+            if fut.done():
+                queue.popleft()
+                if not queue:
+                    del self._queues[user]
+                continue
+            # a request bigger than the whole budget waits for a full bucket instead of forever
+            tokens = min(tokens, self.tpm)
+            if self._requests < 1 or self._tokens < tokens:
+                wait = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+                loop = asyncio.get_running_loop()
+                if self._timer is None or self._timer_loop is not loop:
+                    self._timer = loop.call_later(wait, self._on_timer)
+                    self._timer_loop = loop
+                return
+            queue.popleft()
+            self._requests -= 1
+            self._tokens -= tokens
+            self._in_flight += 1
+            fut.set_result(None)
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._dispatch()
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """Return the difference between the estimate and the usage reported by the API to the bucket"""
+        with self._lock:
+            self._tokens = min(self.tpm, self._tokens + min(estimated_tokens, self.tpm) - used_tokens)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int, user=None):
+        """Wait for the budget to run a request of `tokens` tokens on behalf of `user`"""
+        if user is None:
+            user = llm_user.get()
+        self._loop = asyncio.get_running_loop()
+        fut = self._loop.create_future()
+        with self._lock:
+            self._queues.setdefault(user, deque()).append((tokens, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.contextmanager
+    def blocking_slot(self, tokens: int):
+        """`slot` for synchronous calls made from worker threads, waits by sleeping.
+        Not for the event loop thread: it would stop the requests it waits for"""
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._in_flight < self.max_in_flight and self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    self._in_flight += 1
+                    break
+                wait = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+            # a slot freed by another call doesn't wake us, poll at least every second
+            sleep(min(max(wait, 0.01), 1))
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            # waiting async requests are dispatched on their loop
+            if self._loop is not None:
+                with contextlib.suppress(RuntimeError):
+                    self._loop.call_soon_threadsafe(self._dispatch)
+
+
+limiter = RateLimiter()
+
+
 # In[7]:
 
 
+def completion_data(resp) -> dict:
+    """Plain dict with what callers read from a completion response. `OpenAIObject`s also pickle
+    the API key and client settings, so responses are cached in this form"""
+    return {'choices': [{'message': {'role': c['message'].get('role', 'assistant'),
+                                     'content': c['message']['content']},
+                         'finish_reason': c.get('finish_reason')} for c in resp['choices']],
+            'usage': dict(resp['usage'])}
+
+
+@backoff(RateLimitError)
+async def acreate_chatcompletion(messages, model_name=GPT_MODEL_NAME, user=None,
+                                 temperature: Optional[float] = None, use_cache=True):
+    key = cache.completion_key(model_name, temperature, messages)
+    if use_cache and (resp := cache.completions.get(key)) is not None:
+        return resp
+    params = {} if temperature is None else {'temperature': temperature}
+    tokens = estimate_tokens(messages, model_name=model_name)
+    async with limiter.slot(tokens, user):
+        resp = await openai.ChatCompletion.acreate(
+          model=model_name,
+          messages=messages,
+          **params
+        )
+    limiter.settle(tokens, resp['usage']['total_tokens'])
+    resp = completion_data(resp)
+    if use_cache:
+        cache.completions.set(key, resp)
+    return resp
+
+
+# In[ ]:
+
+
+async def aiter_sse(lines: AsyncIterable[bytes]) -> AsyncGenerator[str, None]:
+    """Data of server-sent events, multiline data fields are joined with a newline"""
+    data = []
+    async for line in lines:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield '\n'.join(data)
+                data = []
+        elif line.startswith('data:'):
+            data.append(line[5:].removeprefix(' '))
+    if data:
+        yield '\n'.join(data)
+
+
+@backoff(RateLimitError)
+async def _open_chatcompletion_stream(payload):
+    response = await get_session().post(f'{openai.api_base}/chat/completions', json=payload, headers={
+        'Authorization': f'Bearer {openai.api_key}',
+    })
+    if response.status != 200:
+        body = await response.text()
+        response.release()
+        if response.status == 429:
+            raise RateLimitError(body, http_status=response.status)
+        raise APIError(body, http_status=response.status)
+    return response
+
+
+async def astream_chatcompletion(messages, model_name=GPT_MODEL_NAME, user=None,
+                                 temperature: Optional[float] = None,
+                                 use_cache=True) -> AsyncGenerator[str, None]:
+    """Yields pieces of the answer as soon as they are generated"""
+    key = cache.completion_key(model_name, temperature, messages)
+    if use_cache and (resp := cache.completions.get(key)) is not None:
+        yield resp['choices'][0]['message']['content']
+        return
+    payload = {'model': model_name, 'messages': messages, 'stream': True}
+    if temperature is not None:
+        payload['temperature'] = temperature
+    tokens = estimate_tokens(messages, model_name=model_name)
+    content = []
+    finish_reason = None
+    async with limiter.slot(tokens, user):
+        response = await _open_chatcompletion_stream(payload)
+        async with response:
+            async for data in aiter_sse(response.content):
+                if data == '[DONE]':
+                    break
+                choice = json.loads(data)['choices'][0]
+                finish_reason = choice.get('finish_reason') or finish_reason
+                if delta := choice['delta'].get('content'):
+                    content.append(delta)
+                    yield delta
+    # streamed responses don't report usage
+    used = tokens - ANSWER_TOKENS_ESTIMATE + tlen(''.join(content))
+    limiter.settle(tokens, used)
+    if use_cache and finish_reason is not None:
+        cache.completions.set(key, {
+            'choices': [{'message': {'role': 'assistant', 'content': ''.join(content)},
+                         'finish_reason': finish_reason}],
+            'usage': {'total_tokens': used}})
+
+
+# In[ ]:
+
+
+EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = 256
+
+
 @backoff(RateLimitError)
-async def acreate_chatcompletion(messages, model_name=GPT_MODEL_NAME):
-    return await openai.ChatCompletion.acreate(
-      model=model_name,
-      messages=messages
-    )
+async def _aembed_batch(texts: List[str], model_name: str, user=None) -> List[List[float]]:
+    tokens = sum(tlen_many(texts))
+    async with limiter.slot(tokens, user):
+        resp = await openai.Embedding.acreate(model=model_name, input=texts)
+    limiter.settle(tokens, resp['usage']['total_tokens'])
+    return [d['embedding'] for d in sorted(resp['data'], key=lambda d: d['index'])]
+
+
+async def aembed(texts: List[str], model_name=EMBEDDING_MODEL_NAME, user=None) -> List[List[float]]:
+    batches = [texts[i:i+EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*[_aembed_batch(b, model_name, user=user) for b in batches])
+    return [e for r in results for e in r]
 
 
 # In[8]:
 
 
-async def map_chatgpt(messages_generator: Callable[[str], List], text: str | tuple | list,
-                      answer_ratio=1/3, overlapping=0.1) -> tuple[List[str], int]:
-    overhead = calc_overhead(messages_generator(''))
+def map_chunk_size(messages_generator: Callable[[str], List], answer_ratio=1/3, model_name=None) -> int:
+    model_name = model_name or GPT_MODEL_NAME
+    overhead = calc_overhead(messages_generator(''), model_name)
+    return int((model_profile(model_name)['context']-overhead)*(1-answer_ratio))
 
-    chunk_size = int((GPT_MAX_CONTEXT_LEN-overhead)*(1-answer_ratio))
+
+async def map_chatgpt(messages_generator: Callable[[str], List], text: str | tuple | list,
+                      answer_ratio=1/3, overlapping=0.1, user=None,
+                      model_name=GPT_MODEL_NAME) -> tuple[List[str], int]:
+    chunk_size = map_chunk_size(messages_generator, answer_ratio, model_name)
     if isinstance(text, str):
         chunking = chunk_a_text(text, chunk_size, overlapping=overlapping)
     else:
@@ -130,7 +558,7 @@ async def map_chatgpt(messages_generator: Callable[[str], List], text: str | tup
     tasks = []
     for c in chunking:
         gi_messages = messages_generator(c)
-        tasks.append(asyncio.create_task(acreate_chatcompletion(gi_messages)))
+        tasks.append(asyncio.create_task(acreate_chatcompletion(gi_messages, model_name=model_name, user=user)))
     resps = await asyncio.gather(*tasks)
     results, toks = zip(*[(r['choices'][0]['message']['content'], r['usage']['total_tokens']) for r in resps])
     return results, sum(toks)
@@ -138,13 +566,16 @@ async def map_chatgpt(messages_generator: Callable[[str], List], text: str | tup
 
 async def map_chatgpt_recursive(messages_generator: Callable[[str], List], text: str | tuple | list,
                                 answer_ratio=1/3, min_improvement=0.3,
-                                tokens_already_used=0) -> tuple[List[str], int]:
+                                tokens_already_used=0, user=None,
+                                model_name=GPT_MODEL_NAME) -> tuple[List[str], int]:
     tok_before = tlen(text if isinstance(text, str) else ' '.join(text))
-    results, tok_used = await map_chatgpt(messages_generator, text)
+    results, tok_used = await map_chatgpt(messages_generator, text, answer_ratio=answer_ratio,
+                                          user=user, model_name=model_name)
     tok_after = tlen(' '.join(results))
     if tok_after > (1-min_improvement)*tok_before:
         return results, tokens_already_used + tok_used
     else:
         return await map_chatgpt_recursive(messages_generator, results, answer_ratio=answer_ratio,
                                            min_improvement=min_improvement, 
-                                           tokens_already_used=tokens_already_used + tok_used)
+                                           tokens_already_used=tokens_already_used + tok_used,
+                                           user=user, model_name=model_name)
@@ -3,18 +3,20 @@
 ####################################################
 import os
 from time import time
-from typing import TypedDict, Generator, List
+from typing import TypedDict, Generator, List, Optional, Tuple
 
-from crabnlp.db import Storage
+from crabnlp.db import open_storage, AsyncStorage
 
 
 ONBOARDING_STORAGE = os.environ.get('INFOMAT_BOT_STORAGE_MAILING', 'data/infomat/mailing.db')
 
-mailing_db = Storage(ONBOARDING_STORAGE)
+mailing_db = open_storage(ONBOARDING_STORAGE)
+amailing_db = AsyncStorage(mailing_db)
 
 KEY_ONBOARDING = 'onboarding'
 KEY_REGISTRATION_TS = 'reg-ts'
 KEY_MAILING_SET = 'mailing-set'
+PAGE_SIZE = 100
 
 class MailingInfo(TypedDict):
     user_id: int
@@ -37,20 +39,95 @@ def get_onboarding(user_id: int):
     return mailing_db[k(user_id, KEY_ONBOARDING)]
 
 
-def register_new_use(user_id: int):
-    mailing_db[k(user_id, KEY_REGISTRATION_TS)] = time()
-    mailing_db[k(user_id, KEY_MAILING_SET)] = set()
+async def aset_onboarding(user_id: int, state: str):
+    await amailing_db.set_value(k(user_id, KEY_ONBOARDING), state)
 
 
-def get_users_mailings() -> Generator[MailingInfo, None, None]:
-    for ur in mailing_db:
-        if ur.endswith(k('', KEY_REGISTRATION_TS)):
-            user_id = ur.split('_', 1)[0]
-            m = mailing_db[k(user_id, KEY_MAILING_SET)]
-            r = mailing_db[k(user_id, KEY_REGISTRATION_TS)]
-            info: MailingInfo = {'user_id': user_id,
-                                 'registered_at': r,
-                                 'mailing_set': m}
-            yield info
+async def aget_onboarding(user_id: int):
+    return await amailing_db.get_value(k(user_id, KEY_ONBOARDING))
 
 
+def register_new_user(user_id: int, registered_at: Optional[float] = None):
+    """Creates the mailing record of a user, indexed by the registration time"""
+    mailing_db.register_mailing_user(user_id, time() if registered_at is None else registered_at)
+
+
+async def aregister_new_user(user_id: int, registered_at: Optional[float] = None):
+    await amailing_db.register_mailing_user(user_id, time() if registered_at is None else registered_at)
+
+
+def get_mailing_info(user_id: int) -> Optional[MailingInfo]:
+    return mailing_db.get_mailing_user(user_id)
+
+
+def add_mailing(user_id: int, mailing: str):
+    """Marks `mailing` as sent to the user"""
+    mailing_db.add_mailing(user_id, mailing)
+
+
+def find_users(registered_from: float, registered_to: float, lacking: Optional[str] = None,
+               after: Optional[Tuple[float, int]] = None,
+               limit: int = PAGE_SIZE) -> Tuple[List[MailingInfo], Optional[Tuple[float, int]]]:
+    """A page of users registered in `[registered_from, registered_to)` without the `lacking` mailing,
+    ordered by registration time. A range scan of the registration index, not of all keys.
+    Returns the page and the cursor to pass as `after` for the next one, `None` after the last page"""
+    return mailing_db.find_mailing_users(registered_from, registered_to, lacking, after, limit)
+
+
+async def afind_users(registered_from: float, registered_to: float, lacking: Optional[str] = None,
+                      after: Optional[Tuple[float, int]] = None,
+                      limit: int = PAGE_SIZE) -> Tuple[List[MailingInfo], Optional[Tuple[float, int]]]:
+    return await amailing_db.find_mailing_users(registered_from, registered_to, lacking, after, limit)
+
+
+def get_users_mailings(lacking: Optional[str] = None) -> Generator[MailingInfo, None, None]:
+    after = None
+    while True:
+        page, after = find_users(0, float('inf'), lacking, after)
+        yield from page
+        if after is None:
+            return
+
+
+def reindex() -> int:
+    """Creates mailing records and the registration index for users registered before them.
+    Scans all keys once, returns the number of added users"""
+    added = 0
+    for key in list(mailing_db):
+        if key.endswith(k('', KEY_REGISTRATION_TS)):
+            user_id = key.split('_', 1)[0]
+            if get_mailing_info(user_id) is None:
+                register_new_user(user_id, mailing_db[key])
+                for mailing in mailing_db[k(user_id, KEY_MAILING_SET)] or ():
+                    add_mailing(user_id, mailing)
+                added += 1
+    return added
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    from crabnlp.db import DAY
+
+    with tempfile.TemporaryDirectory() as d:
+        for filename in ('mailing.db', 'mailing.sqlite'):
+            mailing_db = open_storage(Path(d) / filename)
+            assert find_users(0, time()) == ([], None)
+            now = time()
+            for i, user_id in enumerate([5, 3, 4, 1, 2]):
+                register_new_user(user_id, now - 3 * DAY + i * DAY / 2)
+            add_mailing(4, 'tips')
+            page, after = find_users(0, now, lacking='tips', limit=2)
+            assert [u['user_id'] for u in page] == [5, 3]
+            page, after = find_users(0, now, lacking='tips', after=after, limit=2)
+            assert [u['user_id'] for u in page] == [1, 2] and after == (page[-1]['registered_at'], 2)
+            assert find_users(0, now, lacking='tips', after=after, limit=2) == ([], None)
+            assert [u['user_id'] for u in find_users(now - 2 * DAY, now - DAY)[0]] == [4, 1]
+            assert [u['user_id'] for u in get_users_mailings()] == [5, 3, 4, 1, 2]
+
+            mailing_db[k(7, KEY_REGISTRATION_TS)] = now - 10 * DAY
+            mailing_db[k(7, KEY_MAILING_SET)] = {'tips'}
+            assert reindex() == 1 and reindex() == 0
+            assert get_mailing_info(7)['mailing_set'] == {'tips'}
+            assert [u['user_id'] for u in get_users_mailings(lacking='tips')] == [5, 3, 1, 2]
+            mailing_db.close()
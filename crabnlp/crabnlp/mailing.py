@@ -1,7 +1,7 @@
 import asyncio
 
 from crabnlp.tg import Telegram
-from crabnlp.maildb import register_new_user, MailingInfo
+from crabnlp.maildb import aregister_new_user, MailingInfo
 
 
 MAIL_ASKING_TIPS = 'asking_tips'
@@ -11,7 +11,7 @@ MAIL_ASKING_TIPS = 'asking_tips'
 
 async def on_start(tg: Telegram, user_id: int, lang: str, is_new: bool, logger=None):
     if is_new:
-        register_new_user(user_id)
+        await aregister_new_user(user_id)
 
 
 async def mail_asking_24h(mailing_info: MailingInfo, mailings: set[str], now_ts, bot: Telegram):
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+"""Copies a dbm `Storage` file into SQLite:
+
+    python -m crabnlp.migrate_storage data/infomat/users.db data/infomat/users.sqlite
+
+then point INFOMAT_BOT_STORAGE (or INFOMAT_BOT_STORAGE_MAILING) to the new file.
+"""
+import sys
+
+from crabnlp.db import migrate_dbm_to_sqlite
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    storage = migrate_dbm_to_sqlite(sys.argv[1], sys.argv[2])
+    users, transactions = storage._conn().execute(
+        'SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM transactions)').fetchone()
+    print(f'Migrated {users} users and {transactions} transactions to {sys.argv[2]}')
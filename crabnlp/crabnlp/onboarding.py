@@ -1,5 +1,5 @@
 from crabnlp.tg import Telegram
-from crabnlp.maildb import get_onboarding, set_onboarding
+from crabnlp.maildb import aget_onboarding, aset_onboarding, amailing_db
 
 ONBOARDING_STATE_EXPECTING_YOUTUBE = 'expecting_yt'
 ONBOARDING_STATE_EXPECTING_QUESTION = 'expecting_question'
@@ -50,62 +50,66 @@ messages_onboarding_finished = {
 
 
 async def on_start(tg, user_id, lang: str, is_new: bool, logger=None):
-    is_repeated = get_onboarding(user_id) is not None
-    if is_repeated:
-        set_onboarding(user_id, None)
+    # updates of one user are handled one by one, so the state is checked and changed atomically
+    async with amailing_db.user_lock(user_id):
+        is_repeated = await aget_onboarding(user_id) is not None
+        if is_repeated:
+            await aset_onboarding(user_id, None)
 
-    if logger:
-        logger.info('onboarding', extra={'onboarding_state': 'started', 
-                                         'chat_id': user_id, 'is_repeated': is_repeated})
+        if logger:
+            logger.info('onboarding', extra={'onboarding_state': 'started', 
+                                             'chat_id': user_id, 'is_repeated': is_repeated})
 
-    await tg.send_message_typing(chat_id=user_id, disable_web_page_preview=True,
-                                 text=M(messages_onboarding_intro, lang))
-        
-    await tg.send_message_typing(chat_id=user_id,
-                                 text=M(messages_onboarding_copy, lang))
-    set_onboarding(user_id, ONBOARDING_STATE_EXPECTING_YOUTUBE)
-    if logger:
-        logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_EXPECTING_YOUTUBE, 
-                                         'chat_id': user_id, 'is_repeated': is_repeated})
+        await tg.send_message_typing(chat_id=user_id, disable_web_page_preview=True,
+                                     text=M(messages_onboarding_intro, lang))
+
+        await tg.send_message_typing(chat_id=user_id,
+                                     text=M(messages_onboarding_copy, lang))
+        await aset_onboarding(user_id, ONBOARDING_STATE_EXPECTING_YOUTUBE)
+        if logger:
+            logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_EXPECTING_YOUTUBE, 
+                                             'chat_id': user_id, 'is_repeated': is_repeated})
 
 
 async def on_url_sent(tg: Telegram, user_id: int, update: dict, vid: str, lang: str, logger=None):
-    if get_onboarding(user_id) != ONBOARDING_STATE_EXPECTING_YOUTUBE:
-        return
+    async with amailing_db.user_lock(user_id):
+        if await aget_onboarding(user_id) != ONBOARDING_STATE_EXPECTING_YOUTUBE:
+            return
 
-    message = update['message']
+        message = update['message']
 
-    await tg.send_message_typing(chat_id=message['chat']['id'],
-                                 text=M(messages_onboarding_pinned, lang))
-    
-    if vid != '8KkKuTCFvzI':
-        await tg.send_message_typing(chat_id=message['chat']['id'],
-                                     text=M(messages_onboarding_own_question, lang))
-    else:
         await tg.send_message_typing(chat_id=message['chat']['id'],
-                                     text=M(messages_onboarding_copy_question, lang))                            
-        
-    set_onboarding(user_id, ONBOARDING_STATE_EXPECTING_QUESTION)
-    if logger:
-        logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_EXPECTING_QUESTION, 
-                                         'vid': vid, 'update': update, 'user_id': user_id})
+                                     text=M(messages_onboarding_pinned, lang))
+
+        if vid != '8KkKuTCFvzI':
+            await tg.send_message_typing(chat_id=message['chat']['id'],
+                                         text=M(messages_onboarding_own_question, lang))
+        else:
+            await tg.send_message_typing(chat_id=message['chat']['id'],
+                                         text=M(messages_onboarding_copy_question, lang))                            
+
+        await aset_onboarding(user_id, ONBOARDING_STATE_EXPECTING_QUESTION)
+        if logger:
+            logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_EXPECTING_QUESTION, 
+                                             'vid': vid, 'update': update, 'user_id': user_id})
 
 
 async def on_question_answered(tg: Telegram, user_id: int, lang: str, logger=None):
-    if get_onboarding(user_id) != ONBOARDING_STATE_EXPECTING_QUESTION:
-        return
-    
-    await tg.send_message_typing(chat_id=user_id, text=M(messages_onboarding_wording, lang))
-    
-    chat_info = await tg.post('getChat', chat_id=user_id)
-    if pinned := chat_info['result'].get('pinned_message'):
-        reply_to_message_id = pinned.get('message_id')
-    await tg.send_message_typing(chat_id=user_id, reply_to_message_id=reply_to_message_id,
-                                 text=M(messages_onboarding_price, lang))
+    async with amailing_db.user_lock(user_id):
+        if await aget_onboarding(user_id) != ONBOARDING_STATE_EXPECTING_QUESTION:
+            return
 
-    await tg.send_message_typing(chat_id=user_id, text=M(messages_onboarding_finished, lang))
-    
-    set_onboarding(user_id, ONBOARDING_STATE_FINISHED)
-    if logger:
-        logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_FINISHED,
-                                         'user_id': user_id})
+        await tg.send_message_typing(chat_id=user_id, text=M(messages_onboarding_wording, lang))
+
+        chat_info = await tg.post('getChat', chat_id=user_id)
+        if pinned := chat_info['result'].get('pinned_message'):
+            reply_to_message_id = pinned.get('message_id')
+        await tg.send_message_typing(chat_id=user_id, reply_to_message_id=reply_to_message_id,
+                                     text=M(messages_onboarding_price, lang))
+
+        await tg.send_message_typing(chat_id=user_id, text=M(messages_onboarding_finished, lang))
+
+        await aset_onboarding(user_id, ONBOARDING_STATE_FINISHED)
+        if logger:
+            logger.info('onboarding', extra={'onboarding_state': ONBOARDING_STATE_FINISHED,
+                                             'user_id': user_id})
@@ -13,7 +13,8 @@ import openai
 
 from crabnlp.youtube import adownload_captions_and_meta
 from crabnlp.llms import chunk_a_text, chunk_texts, acreate_chatcompletion, tlen, GPT_MAX_CONTEXT_LEN
-from crabnlp.llms import map_chatgpt, map_chatgpt_recursive
+from crabnlp.llms import map_chatgpt, map_chatgpt_recursive, map_chunk_size, astream_chatcompletion, aembed
+from crabnlp.vector_index import build_index
 
 
 # In[2]:
@@ -54,6 +55,55 @@ async def answer(question, text, context=None, source_type="text", verbose=False
     return '\n'.join(answer).strip(), toks1 + toks2
 
 
+# In[ ]:
+
+
+async def astream_answer(question, text, context=None, source_type="text", user=None):
+    """Same as `answer`, but the final combining call is streamed as it is generated"""
+    if not context:
+        context = "You are a helpfull assistant."
+    gi = lambda t: gather_information(question, t, context, source_type=source_type)
+    results, _ = await map_chatgpt(gi, text, user=user)
+    ca = lambda t: combine_and_answer(question, t, context)
+    chunk_size = map_chunk_size(ca)
+    if len(list(chunk_texts(results, chunk_size))) > 1:
+        results, _ = await map_chatgpt_recursive(ca, results, user=user)
+    for i, chunk in enumerate(chunk_texts(results, chunk_size)):
+        if i:
+            yield '\n'
+        async for delta in astream_chatcompletion(ca(chunk), user=user):
+            yield delta
+
+
+# In[ ]:
+
+
+RETRIEVAL_TOP_K = 6
+
+
+async def answer_retrieval(question, text, context=None, top_k=RETRIEVAL_TOP_K, user=None, verbose=False):
+    """Answers from the `top_k` chunks most similar to the question with a single call.
+    The text is embedded once and the index is reused for all later questions"""
+    if not context:
+        context = "You are a helpfull assistant."
+    index = await build_index(text, user=user)
+    [question_vector] = await aembed([question], user=user)
+    ca = lambda t: combine_and_answer(question, t, context)
+    chunk_size = map_chunk_size(ca)
+    # the least similar chunks are dropped when the best ones don't fit, the rest keep the order of the text
+    kept, size = [], 0
+    for i in index.search(question_vector, top_k):
+        size += tlen(index.chunks[i])
+        if kept and size > chunk_size:
+            break
+        kept.append(i)
+    found = [index.chunks[i] for i in sorted(kept)]
+    if verbose:
+        print(f"{found=}")
+    resp = await acreate_chatcompletion(ca('\n\n'.join(found)), user=user)
+    return resp['choices'][0]['message']['content'].strip(), resp['usage']['total_tokens']
+
+
 # In[9]:
 
 
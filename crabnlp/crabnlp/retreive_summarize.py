@@ -7,10 +7,11 @@ import urllib.request
 from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple, Union
 
-import aiohttp
 import openai
 from bs4 import BeautifulSoup
 
+from crabnlp.http_client import get_session
+
 openai.api_key = os.getenv("OPENAI_KEY")
 google_key = os.getenv("GOOGLE_KEY")
 
@@ -40,15 +41,14 @@ async def _search_knowledge(query: str) -> Optional[str]:
 
 
 async def _search(query: str, count: int):
-	async with aiohttp.ClientSession() as session:
-		async with session.get(
-			f"https://customsearch.googleapis.com/customsearch/v1?cr=ru&num={count}&cx=b0c159ac37f4a413c&q={query}&key={google_key}",
-			timeout=5,
-			headers={"Accept": "application/json"},
-		) as response:
-			json = await response.json()
-			for item in json["items"]:
-				yield item["snippet"]
+	async with get_session().get(
+		f"https://customsearch.googleapis.com/customsearch/v1?cr=ru&num={count}&cx=b0c159ac37f4a413c&q={query}&key={google_key}",
+		timeout=5,
+		headers={"Accept": "application/json"},
+	) as response:
+		json = await response.json()
+	for item in json["items"]:
+		yield item["snippet"]
 
 async def _google(query: str) -> Optional[str]:
 	try:
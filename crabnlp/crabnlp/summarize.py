@@ -14,7 +14,7 @@ from polyglot.detect import Detector
 from polyglot.detect.base import UnknownLanguage
 import tiktoken
 
-from crabnlp.llm import tlen, create, acreate_chatcompletion, chunk_a_text
+from crabnlp.llms import tlen, acreate_chatcompletion, chunk_a_text, chunk_texts, map_chunk_size, GPT_MODEL_NAME, estimate_tokens, limiter
 
 
 # In[2]:
@@ -29,8 +29,9 @@ from crabnlp.llm import tlen, create, acreate_chatcompletion, chunk_a_text
 
 # GPT_MODEL_NAME = "text-curie-001"
 # GPT_MODEL_NAME = "text-davinci-003"
-GPT_MODEL_NAME = "gpt-3.5-turbo"
-GPT_MODEL_MAX_TOKENS = 2049
+SUMMARY_TARGET_TOKENS = 512
+SUMMARY_MAX_LEVELS = 5
+SUMMARY_CONCURRENCY = 8
 openai.api_key = os.environ['OPENAI']
 
 tok = tiktoken.encoding_for_model(GPT_MODEL_NAME)
@@ -81,6 +82,13 @@ PROMPT_SUMMARY = {
 # In[15]:
 
 
+def _summary_messages(text, prompt):
+    return [
+        {"role": "system", "content": ""},
+        {"role": "user", "content": f"{text}\n\n{prompt}"}
+    ]
+
+
 def summarize_with_gpt(text, model_name=GPT_MODEL_NAME):
     assert text
     assert isinstance(text, str)
@@ -91,17 +99,21 @@ def summarize_with_gpt(text, model_name=GPT_MODEL_NAME):
         print(ex)
         lang = 'en'
 
-    resp = openai.ChatCompletion.create(
-      model=model_name,
-      messages=[
-            {"role": "system", "content": ""},
-            {"role": "user", "content": f"{text}\n\n{PROMPT_SUMMARY.get(lang, 'en')}"}
-      ]
-    )
+    messages = [
+        {"role": "system", "content": ""},
+        {"role": "user", "content": f"{text}\n\n{PROMPT_SUMMARY.get(lang, 'en')}"}
+    ]
+    tokens = estimate_tokens(messages, model_name=model_name)
+    with limiter.blocking_slot(tokens):
+        resp = openai.ChatCompletion.create(
+          model=model_name,
+          messages=messages
+        )
+    limiter.settle(tokens, resp['usage']['total_tokens'])
     return resp['choices'][0]['message']['content']
 
 
-async def asummarize_with_gpt(text, model_name=GPT_MODEL_NAME):
+async def asummarize_with_gpt(text, model_name=GPT_MODEL_NAME, user=None):
     assert text
     assert isinstance(text, str)
 
@@ -111,17 +123,15 @@ async def asummarize_with_gpt(text, model_name=GPT_MODEL_NAME):
         print(ex)
         lang = 'en'
 
-    resp = await openai.ChatCompletion.acreate(
-      model=model_name,
-      messages=[
-            {"role": "system", "content": ""},
-            {"role": "user", "content": f"{text}\n\n{PROMPT_SUMMARY.get(lang, 'en')}"}
-      ]
+    resp = await acreate_chatcompletion(
+      _summary_messages(text, PROMPT_SUMMARY.get(lang, 'en')),
+      model_name=model_name,
+      user=user
     )
     return resp['choices'][0]['message']['content']
 
 
-async def asummarize_with_chatgpt(text, model_name=GPT_MODEL_NAME):
+async def asummarize_with_chatgpt(text, model_name=GPT_MODEL_NAME, user=None):
     assert text
     assert isinstance(text, str)
 
@@ -132,10 +142,9 @@ async def asummarize_with_chatgpt(text, model_name=GPT_MODEL_NAME):
         lang = 'en'
 
     resp = await acreate_chatcompletion(
-      messages=[
-            {"role": "system", "content": ""},
-            {"role": "user", "content": f"{text}\n\n{PROMPT_SUMMARY.get(lang, 'en')}"}
-      ]
+      _summary_messages(text, PROMPT_SUMMARY.get(lang, 'en')),
+      model_name=model_name,
+      user=user
     )
     return resp['choices'][0]['message']['content'], resp['usage']['total_tokens']
 
@@ -153,12 +162,12 @@ def summarize_by_chunk(text, chunk_size_in_tokens=2000, max_workers=5):
 # In[17]:
 
 
-async def asummarize_by_chunk(text, chunk_size_in_tokens=2000):
+async def asummarize_by_chunk(text, chunk_size_in_tokens=2000, user=None):
     chunks = list(chunk_a_text(text, chunk_size_in_tokens))
 
     tasks = []
     for c in chunks:
-        tasks.append(asyncio.create_task(asummarize_with_chatgpt(c)))
+        tasks.append(asyncio.create_task(asummarize_with_chatgpt(c, user=user)))
 
     result = await asyncio.gather(*tasks)
     sums, toks = zip(*result)
@@ -168,21 +177,39 @@ async def asummarize_by_chunk(text, chunk_size_in_tokens=2000):
 # In[18]:
 
 
-async def recursive_summarize_with_gpt(text, tries=0, chunk_size_in_tokens=None):
-    if tries > 5:
-        raise RuntimeError("Summarization error", f"Too many attempts. Are you trying to reduce irredubable piece of text? {text=}")
+async def hierarchical_summarize(text, target_tokens=SUMMARY_TARGET_TOKENS, max_levels=SUMMARY_MAX_LEVELS,
+                                 max_concurrency=SUMMARY_CONCURRENCY, chunk_size_in_tokens=None,
+                                 model_name=GPT_MODEL_NAME, user=None) -> tuple[str, List[int]]:
+    """Summarizes chunks of the text concurrently, then summaries of the summaries,
+    until the result fits `target_tokens`. A short text is still summarized once.
+    Returns the summary and tokens used by every level"""
     if chunk_size_in_tokens is None:
-        chunk_size_in_tokens = GPT_MODEL_MAX_TOKENS - 256 - 10
-    sums = []
-    for text in chunk_a_text(text, chunk_size_in_tokens):
-        sums.append(await asummarize_with_gpt(text))
-    if len(sums) == 1:
-        return sums[0]
-    else:
-        print(sums)
-        return await summarize_by_chunk('\n'.join(sums),
-                                                  tries=tries+1,
-                                                  chunk_size_in_tokens=chunk_size_in_tokens)
+        longest_prompt = max(PROMPT_SUMMARY.values(), key=tlen)
+        chunk_size_in_tokens = map_chunk_size(lambda t: _summary_messages(t, longest_prompt), model_name=model_name)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def summarize_chunk(chunk):
+        async with semaphore:
+            return await asummarize_with_chatgpt(chunk, model_name=model_name, user=user)
+
+    tokens_per_level = []
+    if not text.strip():
+        return text, tokens_per_level
+    size = tlen(text)
+    while True:
+        chunks = chunk_texts(text.split('\n'), chunk_size_in_tokens, join_lines_char='\n')
+        sums, toks = zip(*await asyncio.gather(*[summarize_chunk(c) for c in chunks if c.strip()]))
+        tokens_per_level.append(sum(toks))
+        text, previous_size = '\n'.join(s.strip() for s in sums), size
+        size = tlen(text)
+        # when a level doesn't make the text shorter another one would only cost money
+        if size <= target_tokens or len(tokens_per_level) >= max_levels or size >= previous_size:
+            return text, tokens_per_level
+
+
+async def recursive_summarize_with_gpt(text, chunk_size_in_tokens=None):
+    summary, _ = await hierarchical_summarize(text, chunk_size_in_tokens=chunk_size_in_tokens)
+    return summary
 
 
 # In[19]:
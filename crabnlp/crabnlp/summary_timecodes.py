@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from functools import cache, wraps
+from functools import wraps
 import os
 import sys
 import re
@@ -10,67 +10,56 @@ from typing import AsyncGenerator, Generator, List, Optional, Tuple
 import asyncio
 import aiohttp
 from iso639 import languages
+from crabnlp import cache
 from crabnlp.commons import pretty_time
+from crabnlp.http_client import get_session
+from crabnlp.llms import completion_data, estimate_tokens, limiter, GPT_MODEL_NAME
+from crabnlp.youtube import extract_youtube_subtitels_and_refs_pages
 
 
 OPENAI_KEY = os.environ['OPENAI']
 SUMMARIZATION_THRESHOLD = 256
+VIDEO_SUMMARIES_DIR = os.environ.get('CRABNLP_VIDEO_SUMMARIES', 'data/cache/video_summaries')
+VIDEO_SUMMARIES_MAX_BYTES = int(os.environ.get('CRABNLP_VIDEO_SUMMARIES_MAX_BYTES', 256 * 1024 ** 2))
 
-cache = {}
-def memoize(func):
-    """
-    (c) 2021 Nathan Henrie, MIT License
-    https://n8henrie.com/2021/11/decorator-to-memoize-sync-or-async-functions-in-python/
-    """
-
-    async def memoized_async_func(*args, **kwargs):
-        key = (args, frozenset(sorted(kwargs.items())))
-        if key in cache:
-            return cache[key]
-        result = await func(*args, **kwargs)
-        cache[key] = result
-        return result
-
-    def memoized_sync_func(*args, **kwargs):
-        key = (args, frozenset(sorted(kwargs.items())))
-        if key in cache:
-            return cache[key]
-        result = func(*args, **kwargs)
-        cache[key] = result
-        return result
-
-    if asyncio.iscoroutinefunction(func):
-        return memoized_async_func
-    return memoized_sync_func
-
-
-async def req(prompt, session: aiohttp.ClientSession) -> str:
+# page key -> summary of the page, per video
+video_summaries = cache.DiskCache(VIDEO_SUMMARIES_DIR, VIDEO_SUMMARIES_MAX_BYTES)
+
+
+async def req(prompt, session: Optional[aiohttp.ClientSession] = None, user=None) -> str:
     TRIES = 3
+    key = cache.completion_key(GPT_MODEL_NAME, 0, prompt)
+    if (resp := cache.completions.get(key)) is not None:
+        return resp['choices'][0]['message']['content']
+    session = session or get_session()
+    tokens = estimate_tokens(prompt, model_name=GPT_MODEL_NAME)
     for _ in range(TRIES):
         try:
-            async with session.post('https://api.openai.com/v1/chat/completions', headers={
+            async with limiter.slot(tokens, user), session.post('https://api.openai.com/v1/chat/completions', headers={
                     "Authorization": f"Bearer {OPENAI_KEY}",
                     "Content-Type": "application/json",
                 }, json = {
-                    "model": "gpt-3.5-turbo",
+                    "model": GPT_MODEL_NAME,
                     "temperature": 0,
                     "messages": prompt
             }) as res:
 
                 body = await res.json()
+                if 'usage' in body:
+                    limiter.settle(tokens, body['usage']['total_tokens'])
 
-                if res.status != 200:
-                    print(body, file=sys.stderr)
-                    await asyncio.sleep(3)
-                    continue
-
-                body = body['choices'][0]
-                if body['finish_reason'] == 'stop':
-                    break
-                else:
-                    print('too short summarization context')
-                    # todo switched of for price consistence
-                    break
+            if res.status != 200:
+                print(body, file=sys.stderr)
+                await asyncio.sleep(3)
+                continue
+
+            resp, body = body, body['choices'][0]
+            if body['finish_reason'] == 'stop':
+                break
+            else:
+                print('too short summarization context')
+                # todo switched of for price consistence
+                break
         except aiohttp.client_exceptions.ClientOSError as e:
             await asyncio.sleep(3)
             continue
@@ -79,9 +68,9 @@ async def req(prompt, session: aiohttp.ClientSession) -> str:
     if not ('message' in body):
         raise Exception(f"unable to summarize message {body['error']['message']}")
 
+    cache.completions.set(key, completion_data(resp))
     return body['message']['content']
 
-@memoize
 async def gpt_md(page: str, lang: Optional[str]) -> str:
     if lang == None:
         TASK = f'Write a short summary and TL;DR, preserve references in brackets, use language of the original text:\n\n'
@@ -111,15 +100,14 @@ async def gpt_md(page: str, lang: Optional[str]) -> str:
     if len(page) < SUMMARIZATION_THRESHOLD:
         return page
     else:
-        async with aiohttp.ClientSession() as session:
-            example_prompt = TASK + page
-            history_last = history[:2] + [example_prompt]      
-            history_last = [ {"role": "user" if i % 2 == 0 else 'assistant', "content": txt} for i, txt in enumerate(history_last) ] 
-            
-            res = await req(history_last, session)
-            history.append(example_prompt)
-            history.append(res)
-            return res
+        example_prompt = TASK + page
+        history_last = history[:2] + [example_prompt]      
+        history_last = [ {"role": "user" if i % 2 == 0 else 'assistant', "content": txt} for i, txt in enumerate(history_last) ] 
+        
+        res = await req(history_last, get_session())
+        history.append(example_prompt)
+        history.append(res)
+        return res
 
 def enrich_links(text, refs, base_url) -> str:
     start_time = None
@@ -196,3 +184,21 @@ async def summarize_with_timecodes(text_with_refs, refs, base_url, translate_to_
     res = f'<a href="{base_url + str(start_time)}">[{pretty_time(start_time)}]</a> {item_text}'
 
     return res
+
+
+async def summarize_video_incrementally(video_id: str, captions: list, base_url,
+                                        translate_to_languaage_code: Optional[str]) -> Tuple[List[str], str]:
+    """Summaries of all caption pages of a video. Pages summarized by an earlier call for the same video
+    are reused, so re-fetched captions of a live stream only pay for new (or grown) pages.
+    Returns the summaries and the text of the pages summarized by this call"""
+    state_key = cache.content_key('timecodes', video_id, base_url, translate_to_languaage_code, GPT_MODEL_NAME)
+    known = video_summaries.get(state_key, {})
+    pages = list(extract_youtube_subtitels_and_refs_pages(captions))
+    page_keys = [cache.content_key(text, *refs) for text, refs in pages]
+    new_pages = [(key, page) for key, page in zip(page_keys, pages) if key not in known]
+    summaries = await asyncio.gather(*[summarize_with_timecodes(text, refs, base_url, translate_to_languaage_code)
+                                       for _, (text, refs) in new_pages])
+    known = {key: known[key] for key in page_keys if key in known}
+    known.update((key, summary) for (key, _), summary in zip(new_pages, summaries))
+    video_summaries.set(state_key, known)
+    return [known[key] for key in page_keys], ' '.join(page[0] for _, page in new_pages)
@@ -3,7 +3,7 @@
 
 import asyncio
 import aiohttp
-from typing import AsyncGenerator, Generator, Optional, List, Set
+from typing import AsyncGenerator, AsyncIterable, Generator, Optional, List, Set
 import json
 import re
 from contextlib import asynccontextmanager
@@ -12,9 +12,13 @@ from pathlib import Path
 
 from crabnlp.youtube import is_youtube
 from crabnlp.commons import get_json_logger
+from crabnlp.http_client import get_session
 
 
 POLL_TIMEOUT = 1
+MESSAGE_LIMIT = 4096
+# Telegram throttles frequent edits of the same message
+STREAM_EDIT_INTERVAL = 1.5
 
 ENTITY_BOT_COMMAND = 'bot_command'
 ENTITY_URL = 'url'
@@ -70,20 +74,19 @@ class Telegram:
 
     async def post(self, method: str, fail_on_error=False, **kwargs):
         url = f'https://api.telegram.org/bot{self.token}/{method}'
-        async with aiohttp.ClientSession() as session:
-            started = monotonic()
-            async with session.post(url, json=kwargs) as response:
-                try:
-                    j = await response.json()
-                except:
-                    j = {'text': await response.text}
-                rt = monotonic() - started
-                self.posts_logger.info({'method': method, 'status': response.status,
-                                        'request': kwargs, 'response': j,
-                                        'response_time': rt})
-                if fail_on_error and response.status != 200:
-                    raise Exception(f'Failed to call `{method}`: {response.status}, {await response.text()}')
-                return j
+        started = monotonic()
+        async with get_session().post(url, json=kwargs) as response:
+            try:
+                j = await response.json()
+            except:
+                j = {'text': await response.text}
+            rt = monotonic() - started
+            self.posts_logger.info({'method': method, 'status': response.status,
+                                    'request': kwargs, 'response': j,
+                                    'response_time': rt})
+            if fail_on_error and response.status != 200:
+                raise Exception(f'Failed to call `{method}`: {response.status}, {await response.text()}')
+            return j
 
     async def upload_video(self, file_path, **kwargs):
         url = f'https://api.telegram.org/bot{self.token}/sendVideo'
@@ -94,9 +97,9 @@ class Telegram:
         for k, v in kwargs.items():
             v_ = v if type(v) != int else json.dumps(v)
             data.add_field(k, json.dumps(v), content_type='application/json')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data) as response:
-                return await response.json()
+        # uploads may take longer than the default request timeout
+        async with get_session().post(url, data=data, timeout=aiohttp.ClientTimeout(total=None)) as response:
+            return await response.json()
 
     async def delete_message(self, fail_on_error=False, **kwargs) -> dict:
         return await self.post('deleteMessage', **kwargs)
@@ -147,22 +150,59 @@ class Telegram:
 
         return r
 
+    async def stream_message(self, chunks: AsyncIterable[str], chat_id, placeholder='…',
+                             edit_interval=STREAM_EDIT_INTERVAL, **kwargs) -> Optional[dict]:
+        """Sends a message and edits it as `chunks` arrive, at most once per `edit_interval` seconds.
+        Text over the message limit continues in a reply. Partial edits are plain text, `kwargs`
+        (e.g. `parse_mode`) apply to the final edit of every message, which falls back to plain text
+        if Telegram rejects it (a cut can split a tag). An empty placeholder is deleted.
+        Returns the response of the last edit, `None` for an empty stream"""
+        r = await self.post('sendMessage', fail_on_error=True, chat_id=chat_id, text=placeholder)
+        message_id = r['result']['message_id']
+        text, shown, last_edit, edited = '', placeholder, monotonic(), None
+
+        async def show(new_text, final=False):
+            nonlocal edited, shown, last_edit
+            if not new_text.strip() or (new_text == shown and not (final and kwargs)):
+                return
+            params = kwargs if final else {}
+            edited = await self.edit_message_text(chat_id=chat_id, message_id=message_id, text=new_text, **params)
+            if not edited.get('ok', True) and params:
+                edited = await self.edit_message_text(chat_id=chat_id, message_id=message_id, text=new_text)
+            shown, last_edit = new_text, monotonic()
+
+        async for chunk in chunks:
+            text += chunk
+            while len(text) > MESSAGE_LIMIT:
+                cut = text.rfind('\n', 0, MESSAGE_LIMIT) + 1 or MESSAGE_LIMIT
+                await show(text[:cut], final=True)
+                text = text[cut:]
+                r = await self.post('sendMessage', fail_on_error=True, chat_id=chat_id, text=placeholder,
+                                    reply_to_message_id=message_id)
+                message_id, shown = r['result']['message_id'], placeholder
+            if monotonic() - last_edit >= edit_interval:
+                await show(text)
+        if text.strip():
+            await show(text, final=True)
+        else:
+            await self.delete_message(chat_id=chat_id, message_id=message_id)
+        return edited
+
     async def poll(self, poll_timeout=POLL_TIMEOUT) -> AsyncGenerator:
-        async with aiohttp.ClientSession() as session:
-            while True:
-                url = f'https://api.telegram.org/bot{self.token}/getUpdates?limit=1&offset={self.polling_offset}'
-                async with session.get(url) as response:
-                    resp = await response.json()
-                    if (updates := resp.get('result')) is not None:
-                        for u in updates:
-                            self.polling_offset = u['update_id'] + 1
-                            self.updates_logger.info(u)
-                            yield u
-                    else:
-                        print('NO RESULT', resp)
-                        self.updates_logger.error(resp)
-
-                await asyncio.sleep(poll_timeout)
+        while True:
+            url = f'https://api.telegram.org/bot{self.token}/getUpdates?limit=1&offset={self.polling_offset}'
+            async with get_session().get(url) as response:
+                resp = await response.json()
+            if (updates := resp.get('result')) is not None:
+                for u in updates:
+                    self.polling_offset = u['update_id'] + 1
+                    self.updates_logger.info(u)
+                    yield u
+            else:
+                print('NO RESULT', resp)
+                self.updates_logger.error(resp)
+
+            await asyncio.sleep(poll_timeout)
 
     @asynccontextmanager
     async def chat_action(self, chat_id, action='typing'):
@@ -1,13 +1,84 @@
+import io
 import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 import openai
+import torch
+
+from crabnlp import cache
+from crabnlp.audio import load_audio
+from crabnlp.llms import limiter
+from crabnlp.whisper import SAMPLE_RATE, VAD_FRAME
 openai.api_key = os.environ['OPENAI']
 
+MODEL_NAME = 'whisper-1'
+MAX_FILE_SIZE = 25000000
+MAX_PART_SECONDS = 10 * 60  # a part is sent as 16 kHz mono wav, about 19 MB
+SPLIT_SEARCH_SECONDS = 30  # a part is cut at the quietest moment of its last seconds
+MAX_PARALLEL_UPLOADS = 4
+
+
+def _split_ranges(pcm: torch.Tensor, max_samples: int = MAX_PART_SECONDS * SAMPLE_RATE,
+				  search: int = SPLIT_SEARCH_SECONDS * SAMPLE_RATE) -> List[Tuple[int, int]]:
+	ranges, start = [], 0
+	while len(pcm) - start > max_samples:
+		window = pcm[start + max_samples - search:start + max_samples, 0].to(torch.float32)
+		energy = window[:len(window) // VAD_FRAME * VAD_FRAME].reshape(-1, VAD_FRAME).pow(2).mean(dim=1)
+		cut = start + max_samples - search + int(energy.argmin()) * VAD_FRAME
+		ranges.append((start, cut))
+		start = cut
+	ranges.append((start, len(pcm)))
+	return ranges
+
+
+def _transcribe_part(pcm: torch.Tensor) -> dict:
+	buffer = io.BytesIO()
+	with wave.open(buffer, 'wb') as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(SAMPLE_RATE)
+		w.writeframes(pcm.to(torch.int16).numpy().tobytes())
+	# audio is billed by duration, only requests count against the limits
+	with limiter.blocking_slot(0):
+		return openai.Audio.transcribe_raw(MODEL_NAME, buffer.getvalue(), 'part.wav', response_format='verbose_json')
+
+
+def transcribe(filepath, max_workers=MAX_PARALLEL_UPLOADS, use_cache=True):
+	"""Returns text and segments with timings. Files over the API limit are split at
+	silences into parts transcribed in parallel, part timings are shifted to the whole file.
+	Results are cached by the file content."""
+	if not use_cache:
+		return _transcribe_file(filepath, max_workers)
+
+	key = cache.file_key(filepath, MODEL_NAME, 'verbose_json', MAX_PART_SECONDS, SPLIT_SEARCH_SECONDS)
+	if (result := cache.transcripts.get(key)) is not None:
+		return result
+	result = _transcribe_file(filepath, max_workers)
+	cache.transcripts.set(key, result)
+	return result
+
+
+def _transcribe_file(filepath, max_workers):
+	if os.stat(filepath).st_size <= MAX_FILE_SIZE:
+		with open(filepath, 'rb') as f, limiter.blocking_slot(0):
+			transcript = openai.Audio.transcribe(MODEL_NAME, f, response_format='verbose_json')
+		# plain dicts, `OpenAIObject`s would pickle the API key into the cache
+		return transcript['text'], [dict(segment) for segment in transcript['segments']]
+
+	pcm = load_audio(filepath)
+	ranges = _split_ranges(pcm)
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		parts = list(executor.map(lambda r: _transcribe_part(pcm[r[0]:r[1]]), ranges))
 
-def transcribe(filepath):
-	if os.stat(filepath).st_size > 25000000:
-		raise Exception(f'File too big: {filepath} for transcription')
-	MODEL_NAME = 'whisper-1'
-	with open(filepath, 'rb') as f:
-		transcript = openai.Audio.transcribe(MODEL_NAME, f, response_format='verbose_json')
-	return transcript['text'], None
\ No newline at end of file
+	segments = []
+	for (start, _), part in zip(ranges, parts):
+		offset = start / SAMPLE_RATE
+		for segment in part['segments']:
+			segment = dict(segment)
+			segment['id'] = len(segments)
+			segment['start'] += offset
+			segment['end'] += offset
+			segments.append(segment)
+	return ' '.join(part['text'].strip() for part in parts), segments
@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from crabnlp import cache
+from crabnlp.llms import aembed, chunk_a_text, chunk_texts, EMBEDDING_MODEL_NAME
+
+
+INDEX_DIR = os.environ.get('CRABNLP_INDEX_DIR', 'data/cache/index')
+INDEX_CHUNK_TOKENS = 400
+
+
+class VectorIndex:
+    """Text chunks with unit length float16 embeddings, searched by cosine similarity"""
+    def __init__(self, chunks: List[str], vectors: np.ndarray):
+        assert len(chunks) == len(vectors)
+        self.chunks = chunks
+        self.vectors = vectors.astype(np.float16)
+
+    def search(self, vector, k: int) -> List[int]:
+        """Indices of the `k` chunks closest to `vector`, the closest first"""
+        if not self.chunks:
+            return []
+        scores = self.vectors.astype(np.float32) @ _normalize(np.asarray(vector, dtype=np.float32))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind='stable')].tolist()
+
+    def save(self, path):
+        """Vectors go to `<path>.npy`, chunks to `<path>.json`"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for suffix, write in (('.npy', lambda f: np.save(f, self.vectors)),
+                              ('.json', lambda f: f.write(json.dumps(self.chunks, ensure_ascii=False).encode()))):
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', delete=False) as f:
+                write(f)
+            os.replace(f.name, path.with_suffix(suffix))
+
+    @classmethod
+    def load(cls, path) -> 'VectorIndex':
+        path = Path(path)
+        with open(path.with_suffix('.json'), encoding='utf-8') as f:
+            chunks = json.load(f)
+        return cls(chunks, np.load(path.with_suffix('.npy')))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _index_path(key: str) -> Path:
+    return Path(INDEX_DIR) / key[:2] / key
+
+
+async def build_index(text: str | tuple | list, chunk_tokens=INDEX_CHUNK_TOKENS, user=None) -> VectorIndex:
+    """Embeds chunks of `text` once, later calls with the same text load the index from disk"""
+    joined = text if isinstance(text, str) else '\n'.join(text)
+    key = cache.content_key('index', EMBEDDING_MODEL_NAME, chunk_tokens, joined)
+    path = _index_path(key)
+    if path.with_suffix('.npy').exists():
+        try:
+            return VectorIndex.load(path)
+        except (OSError, ValueError):
+            pass
+    if isinstance(text, str):
+        chunks = list(chunk_a_text(text, chunk_tokens))
+    else:
+        chunks = list(chunk_texts(list(text), chunk_tokens, join_lines_char=' '))
+    chunks = [c for c in chunks if c]
+    if not chunks:
+        return VectorIndex([], np.zeros((0, 0), dtype=np.float32))
+    vectors = np.array(await aembed(chunks, user=user), dtype=np.float32).reshape(len(chunks), -1)
+    index = VectorIndex(chunks, _normalize(vectors))
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as d:
+        index = VectorIndex(['a', 'b', 'c'], _normalize(np.array([[1, 0], [0, 1], [1, 1]], dtype=np.float32)))
+        assert index.search([1, 0.1], 2) == [0, 2]
+        assert index.search([0.1, 1], 3) == [1, 2, 0]
+        assert VectorIndex([], np.zeros((0, 0))).search([1, 0], 2) == []
+        index.save(Path(d) / 'x')
+        loaded = VectorIndex.load(Path(d) / 'x')
+        assert loaded.chunks == index.chunks and loaded.vectors.dtype == np.float16
+        assert loaded.search([0, 1], 1) == [1]
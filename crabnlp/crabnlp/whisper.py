@@ -1,13 +1,93 @@
+import asyncio
+import os
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic
 import torch
-from typing import Iterable, List, Tuple
-from faster_whisper import WhisperModel
-from pyannote.audio import Model
-from einops import rearrange, repeat
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Optional, Tuple, TypedDict
+from einops import rearrange
 
+from crabnlp import cache
+
+
+DEFAULT_MODELS_CONFIG = {
+	'models_dir': os.environ.get('CRABNLP_MODELS_DIR', 'models'),
+	'whisper_size': os.environ.get('CRABNLP_WHISPER_SIZE', 'medium'),
+	'device': os.environ.get('CRABNLP_DEVICE', 'cpu'),
+	'compute_type': os.environ.get('CRABNLP_COMPUTE_TYPE', 'int8'),
+	'cpu_threads': int(os.environ.get('CRABNLP_CPU_THREADS', 0)),  # 0 means library default
+	'num_workers': int(os.environ.get('CRABNLP_NUM_WORKERS', 1)),
+}
+
+
+class ModelRegistry:
+	"""Loads models on first use and shares one instance between all transcriber sessions of the process"""
+	def __init__(self, **config):
+		self.config = dict(DEFAULT_MODELS_CONFIG)
+		self.config.update(config)
+		self._models = {}
+		self._lock = threading.Lock()
+
+	def configure(self, **config):
+		unknown = set(config) - set(DEFAULT_MODELS_CONFIG)
+		if unknown:
+			raise ValueError(f'Unknown model options {unknown}')
+		with self._lock:
+			if self._models:
+				raise RuntimeError(f'Models {list(self._models)} are already loaded')
+			self.config.update(config)
+
+	def _get(self, name, load):
+		if (model := self._models.get(name)) is None:
+			with self._lock:
+				if (model := self._models.get(name)) is None:
+					model = self._models[name] = load()
+		return model
+
+	def _load_pyannote(self, name):
+		from pyannote.audio import Model
+
+		if self.config['cpu_threads']:
+			torch.set_num_threads(self.config['cpu_threads'])
+		model = Model.from_pretrained(str(Path(self.config['models_dir']) / f'{name}.pyannotate' / 'pytorch_model.bin'))
+		return model.to(torch.device(self.config['device'])).eval()
+
+	def _load_whisper(self):
+		from faster_whisper import WhisperModel
+
+		return WhisperModel(str(Path(self.config['models_dir']) / f"whisper-{self.config['whisper_size']}-ct2"),
+							device=self.config['device'],
+							compute_type=self.config['compute_type'],
+							cpu_threads=self.config['cpu_threads'],
+							num_workers=self.config['num_workers'])
+
+	@property
+	def segmentation(self):
+		return self._get('segmentation', lambda: self._load_pyannote('segmentation'))
+
+	@property
+	def embedding(self):
+		return self._get('embedding', lambda: self._load_pyannote('embedding'))
+
+	@property
+	def transcriber(self):
+		return self._get('transcriber', self._load_whisper)
+
+
+models = ModelRegistry()
+
+_MODEL_ATTRIBUTES = {'segmentation_model': 'segmentation',
+					 'embedding_model': 'embedding',
+					 'transcriber_model': 'transcriber'}
+
+
+def __getattr__(name):
+	if name in _MODEL_ATTRIBUTES:
+		return getattr(models, _MODEL_ATTRIBUTES[name])
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-segmentation_model = Model.from_pretrained("models/segmentation.pyannotate/pytorch_model.bin")
-embedding_model = Model.from_pretrained("models/embedding.pyannotate/pytorch_model.bin")
-transcriber_model = WhisperModel('models/whisper-medium-ct2', device='cpu', compute_type='int8')
 
 SAMPLE_RATE = 16000
 N_FFT = 400
@@ -22,64 +102,290 @@ FRAMES_PER_SECOND = SAMPLE_RATE // HOP_LENGTH  # 10ms per audio frame
 assert SAMPLE_RATE % HOP_LENGTH == 0
 TOKENS_PER_SECOND = SAMPLE_RATE // N_SAMPLES_PER_TOKEN  # 20ms per audio token
 assert SAMPLE_RATE % N_SAMPLES_PER_TOKEN == 0
+BATCH_GAP = SAMPLE_RATE // 2  # silence between segments packed into one decoding window
 
+SPEAKER_DISTANCE_THRESHOLD = 0.6
 
-def _merge_pauses(time_ranges: List[Tuple[int, int]], speakers: List[int]) -> Tuple[List[Tuple[int, int]], List[int]]:
-	_segments = []
-	_speakers = []
+VAD_FRAME = SAMPLE_RATE // 50  # 20 ms energy frames
+VAD_MIN_DBFS = -50  # never speech below this level
+VAD_MAX_DBFS = -35  # always speech above this level, even when a chunk is loud all along
+VAD_MARGIN_DB = 10  # speech is louder than the noise floor of a chunk by this margin
+VAD_PADDING = SAMPLE_RATE // 2  # speech is extended on both sides, so shorter pauses are kept
+VAD_MIN_SPEECH = SAMPLE_RATE  # with `vad`, chunks with less speech are skipped entirely
 
-	for (start, end), speaker in zip(time_ranges, speakers):
-		prev_speaker = _speakers[-1] if len(_speakers) > 0 else None
+DECODING_SEQUENTIAL = 'sequential'
+DECODING_BATCHED = 'batched'
+
+
+def _merge_pauses(starts: torch.Tensor, ends: torch.Tensor, speakers: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+	"""Drops short turns and short non speech (-1) runs, joins consecutive turns of the same speaker.
+	Works on run-length encoded turns, every rule is a vectorized tensor operation."""
+	if len(speakers) == 0:
+		return starts, ends, speakers
+	lengths = ends - starts
+	long = ~(((lengths < 3 * SAMPLE_RATE) & (speakers == -1)) | (lengths < 1 * SAMPLE_RATE))
+
+	# speaker of the last long turn before every turn, short turns of that speaker are kept and joined
+	idx = torch.arange(len(speakers))
+	last_long = torch.cummax(torch.where(long, idx, -1), dim=0).values
+	prev_long = torch.cat((torch.tensor([-1]), last_long[:-1]))
+	prev_speaker = torch.where(prev_long >= 0, speakers[prev_long.clamp(min=0)], -2)
+	keep = long | (speakers == prev_speaker)
+	starts, ends, speakers = starts[keep], ends[keep], speakers[keep]
+
+	first = torch.ones(len(speakers), dtype=torch.bool)
+	first[1:] = speakers[1:] != speakers[:-1]
+	last = torch.ones(len(speakers), dtype=torch.bool)
+	last[:-1] = first[1:]
+	return starts[first], ends[last], speakers[first]
+
+
+assert [t.tolist() for t in _merge_pauses(torch.tensor([0, 5, 5.5, 9, 13]) * SAMPLE_RATE,
+										  torch.tensor([5, 5.5, 9, 13, 20]) * SAMPLE_RATE,
+										  torch.tensor([0, 1, 0, -1, 1]))] == \
+	[[0, 9 * SAMPLE_RATE, 13 * SAMPLE_RATE], [9 * SAMPLE_RATE, 13 * SAMPLE_RATE, 20 * SAMPLE_RATE], [0, -1, 1]]
 
-		if speaker == prev_speaker:
-			start_prev, _ = _segments.pop()
-			_segments.append((start_prev, end))
-		elif ((end - start < 3 * SAMPLE_RATE) and speaker == -1) or (end - start < 1 * SAMPLE_RATE):
-			if len(_segments) > 0:
-				start_prev, end = _segments.pop()
-				_segments.append((start_prev, end))
-		else:
-			_segments.append((start, end))
-			_speakers.append(speaker)
 
-	return _segments, _speakers
+def _speaker_ranges(frame_speakers: torch.Tensor, samples_num: int, resolution: int) -> Tuple[List[Tuple[int, int]], List[int]]:
+	"""Turns frame level speaker indexes into merged sample ranges without expanding them to samples.
+	Frames are aligned to the end of the audio, the uncovered beginning is non speech."""
+	speakers, counts = torch.unique_consecutive(frame_speakers, return_counts=True)
+	offset = samples_num - len(frame_speakers) * resolution
+	ends = offset + torch.cumsum(counts, 0) * resolution
+	starts = ends - counts * resolution
+	if offset > 0:
+		starts = torch.cat((torch.tensor([0]), starts))
+		ends = torch.cat((torch.tensor([offset]), ends))
+		speakers = torch.cat((torch.tensor([-1]), speakers))
 
+	starts, ends = starts.clamp(0, samples_num), ends.clamp(0, samples_num)
+	nonempty = ends > starts
+	starts, ends, speakers = starts[nonempty], ends[nonempty], speakers[nonempty]
 
-def _diarize_speakers(pcm_sound: torch.Tensor, speaker_indexes: torch.Tensor) -> Iterable[Tuple[torch.Tensor, Tuple[int, int], int]]:
+	# the uncovered beginning joins a non speech first run
+	first = torch.ones(len(speakers), dtype=torch.bool)
+	first[1:] = speakers[1:] != speakers[:-1]
+	starts, ends, speakers = starts[first], torch.cat((starts[first][1:], ends[-1:])), speakers[first]
+
+	starts, ends, speakers = _merge_pauses(starts, ends, speakers)
+	return list(zip(starts.tolist(), ends.tolist())), speakers.tolist()
+
+
+def _diarize_speakers(pcm_sound: torch.Tensor, frame_speakers: torch.Tensor) -> Iterable[Tuple[torch.Tensor, Tuple[int, int], int]]:
 	assert pcm_sound.shape[1] == 1, 'for diarization should be only 1 channel presents'
 	pcm_sound = pcm_sound.squeeze()
-	assert len(pcm_sound) == len(speaker_indexes), "Input tensors must be the same length"
-	
-	# Get the indices where the speaker changes
-	change_indices = torch.where(speaker_indexes[:-1] != speaker_indexes[1:])[0]
-	change_indices = torch.cat((torch.tensor([0]), change_indices + 1, torch.tensor([len(pcm_sound)])))
 
-	time_ranges = [(change_indices[i].item(), change_indices[i+1].item()) for i in range(len(change_indices)-1)]
-	speakers = [ speaker_indexes[start].item() for start, _ in time_ranges]
-	time_ranges, speakers = _merge_pauses(time_ranges, speakers)
+	time_ranges, speakers = _speaker_ranges(frame_speakers, len(pcm_sound), _frame_resolution())
 
-	# Split pcm_sound into segments based on change_indices
+	# Split pcm_sound into segments based on speaker turns
 	segments = [pcm_sound[start:end] for start, end in time_ranges]
 	
 	return zip(segments, [ (start // SAMPLE_RATE, end // SAMPLE_RATE) for start, end in time_ranges], speakers)
 
+def _speech_ranges(pcm: torch.Tensor) -> List[Tuple[int, int]]:
+	"""Energy based voice activity detection, returns sample ranges containing speech"""
+	wave = pcm.reshape(-1).to(torch.float32) / 32768.0
+	n_frames = len(wave) // VAD_FRAME
+	if n_frames == 0:
+		return [(0, len(wave))] if len(wave) else []
+
+	frames = wave[:n_frames * VAD_FRAME].reshape(n_frames, VAD_FRAME)
+	db = 10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)
+	threshold = min(max(VAD_MIN_DBFS, torch.quantile(db, 0.1).item() + VAD_MARGIN_DB), VAD_MAX_DBFS)
+	pad = VAD_PADDING // VAD_FRAME
+	speech = torch.nn.functional.max_pool1d((db > threshold).to(torch.float32)[None, None], 2 * pad + 1, stride=1, padding=pad)[0, 0] > 0
+
+	edges = torch.diff(speech.to(torch.int8), prepend=torch.zeros(1, dtype=torch.int8), append=torch.zeros(1, dtype=torch.int8))
+	starts = torch.where(edges == 1)[0] * VAD_FRAME
+	ends = torch.where(edges == -1)[0] * VAD_FRAME
+	ends[ends == n_frames * VAD_FRAME] = len(wave)  # the tail shorter than a frame follows the last frame
+	return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _compact(pcm: torch.Tensor, speech_ranges: List[Tuple[int, int]]) -> torch.Tensor:
+	if speech_ranges == [(0, len(pcm))]:
+		return pcm
+	return torch.cat([pcm[start:end] for start, end in speech_ranges]) if speech_ranges else pcm[:0]
+
+
+def _restore_times(time_ranges: List[Tuple[int, int]], speech_ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+	"""Maps sample ranges of `_compact` audio back to the original audio"""
+	if not time_ranges:
+		return []
+	starts = torch.tensor([start for start, _ in speech_ranges])
+	lengths = torch.tensor([end - start for start, end in speech_ranges])
+	offsets = torch.cumsum(lengths, 0) - lengths  # compact position of every speech range
+
+	def restore(positions):
+		idx = torch.searchsorted(offsets, positions, right=True) - 1
+		return starts[idx] + positions - offsets[idx]
+
+	begins = restore(torch.tensor([start for start, _ in time_ranges]))
+	ends = restore(torch.tensor([end for _, end in time_ranges]) - 1) + 1
+	return list(zip(begins.tolist(), ends.tolist()))
+
+
+assert _restore_times([(0, 5), (5, 15)], [(10, 20), (30, 40)]) == [(10, 15), (15, 35)]
+
+
 def _transcribe_pcm(pcm: torch.Tensor, prev_text: str) -> str:
 	segment = (pcm.to(torch.float32) / 32768.0).numpy()
-	segments, _ = transcriber_model.transcribe(segment, language='ru', temperature=0, condition_on_previous_text=True, initial_prompt=prev_text)
+	segments, _ = models.transcriber.transcribe(segment, language='ru', temperature=0, condition_on_previous_text=True, initial_prompt=prev_text)
 	return ' '.join([ segment.text for segment in segments ])
 
-def _nearest(vector: torch.Tensor, db_matrix: torch.Tensor) -> int:
-    return torch.argmin(torch.norm(db_matrix - vector.unsqueeze(0), dim=1)).item()
 
-#def _nearest(vector: torch.Tensor, db_matrix: torch.Tensor) -> Tuple[int, torch.Tensor]:
-#    nearest_idx = torch.argmin(torch.norm(db_matrix - vector.unsqueeze(0), dim=1)).item()
-#    db_matrix[nearest_idx] = (vector + db_matrix[nearest_idx]) / 2
-#    return nearest_idx, db_matrix
+def _pack_windows(lengths: List[int], window: int = N_SAMPLES, gap: int = BATCH_GAP) -> List[List[int]]:
+	"""Greedily groups segment indexes into windows of at most `window` samples"""
+	windows, current, used = [], [], 0
+	for i, n in enumerate(lengths):
+		need = used + gap + n if current else n
+		if current and need > window:
+			windows.append(current)
+			current, need = [], n
+		current.append(i)
+		used = need
+	if current:
+		windows.append(current)
+	return windows
+
+
+assert _pack_windows([10, 10, 10], window=25, gap=2) == [[0, 1], [2]]
+assert _pack_windows([30, 10], window=25, gap=2) == [[0], [1]]
+
+
+def _transcribe_batch(pcms: List[torch.Tensor]) -> List[str]:
+	"""Decodes many segments packed into `CHUNK_LENGTH` windows, one encoder pass per window.
+	Words are mapped back to their segments by timestamps."""
+	texts = [[] for _ in pcms]
+	for window in _pack_windows([len(pcm) for pcm in pcms]):
+		pieces, ends, pos = [], [], 0
+		for i in window:
+			if pieces:
+				pieces.append(torch.zeros(BATCH_GAP, dtype=pcms[i].dtype))
+				pos += BATCH_GAP
+			pieces.append(pcms[i])
+			pos += len(pcms[i])
+			ends.append(pos / SAMPLE_RATE)
+
+		audio = (torch.cat(pieces).to(torch.float32) / 32768.0).numpy()
+		segments, _ = models.transcriber.transcribe(audio, language='ru', temperature=0, condition_on_previous_text=False, word_timestamps=True)
+		for segment in segments:
+			for word in segment.words:
+				k = min(bisect_left(ends, (word.start + word.end) / 2), len(window) - 1)
+				texts[window[k]].append(word.word)
+	return [''.join(words).strip() for words in texts]
+
+
+class _DecodingBatcher:
+	"""Collects segments from all concurrent sessions and decodes them with `_transcribe_batch`"""
+	def __init__(self, max_delay: float = 0.05):
+		self.max_delay = max_delay
+		self.pending = []
+		self.pending_samples = 0
+		self.flush_handle = None
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch-decode')
+
+	async def decode(self, pcm: torch.Tensor) -> str:
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self.pending.append((pcm, future))
+		self.pending_samples += len(pcm)
+		if self.pending_samples >= N_SAMPLES:
+			self._flush()
+		elif self.flush_handle is None:
+			self.flush_handle = loop.call_later(self.max_delay, self._flush)
+		return await future
+
+	def _flush(self):
+		if self.flush_handle is not None:
+			self.flush_handle.cancel()
+			self.flush_handle = None
+		batch, self.pending, self.pending_samples = self.pending, [], 0
+		if not batch:
+			return
+
+		def resolve(task):
+			for i, (_, future) in enumerate(batch):
+				if future.done():
+					continue
+				if task.exception() is not None:
+					future.set_exception(task.exception())
+				else:
+					future.set_result(task.result()[i])
+
+		task = asyncio.get_running_loop().run_in_executor(self.executor, _transcribe_batch, [pcm for pcm, _ in batch])
+		task.add_done_callback(resolve)
+
+
+_batcher = None
+
+def _get_batcher() -> _DecodingBatcher:
+	global _batcher
+	if _batcher is None:
+		_batcher = _DecodingBatcher()
+	return _batcher
+
+class SpeakerRegistry:
+	"""Running centroids of the speakers of a session, keeps speaker labels stable across chunks"""
+	def __init__(self, threshold: float = SPEAKER_DISTANCE_THRESHOLD):
+		self.threshold = threshold
+		self.centroids = None  # shape (speakers, emb_dim), normalized embeddings averages
+		self.counts = None
+
+	def assign(self, embeddings: torch.Tensor) -> List[int]:
+		"""Maps embeddings of distinct speakers of one chunk to known speakers.
+		Embeddings farther than `threshold` (cosine distance) from every centroid become new speakers."""
+		embeddings = torch.nn.functional.normalize(embeddings.to(torch.float32), dim=1)
+		ids = [-1] * len(embeddings)
+		if self.centroids is not None:
+			distances = 1 - embeddings @ torch.nn.functional.normalize(self.centroids, dim=1).T  # shape (K, M)
+			taken = set()
+			# greedy matching, speakers of one chunk are different people
+			for flat in torch.argsort(distances.flatten()).tolist():
+				k, m = divmod(flat, distances.shape[1])
+				if distances[k, m] > self.threshold:
+					break
+				if ids[k] == -1 and m not in taken:
+					ids[k] = m
+					taken.add(m)
+
+		for k, m in enumerate(ids):
+			if m == -1:
+				ids[k] = self._add(embeddings[k])
+			else:
+				self.counts[m] += 1
+				self.centroids[m] += (embeddings[k] - self.centroids[m]) / self.counts[m]
+		return ids
+
+	def _add(self, embedding: torch.Tensor) -> int:
+		if self.centroids is None:
+			self.centroids = embedding.unsqueeze(0).clone()
+			self.counts = torch.ones(1)
+		else:
+			self.centroids = torch.cat((self.centroids, embedding.unsqueeze(0)))
+			self.counts = torch.cat((self.counts, torch.ones(1)))
+		return len(self.centroids) - 1
+
+
+def _speaker_names(registry: SpeakerRegistry, speakers: List[int], speaker_embeddings: torch.Tensor) -> List[str]:
+	"""Labels local speaker indexes of a chunk, non speech (-1) gets an empty name"""
+	active = sorted({s for s in speakers if s >= 0})
+	ids = dict(zip(active, registry.assign(speaker_embeddings[active]))) if active else {}
+	return ['Спикер ' + str(ids[s]) if s in ids else '' for s in speakers]
+
+def _frame_resolution() -> int:
+	"""Samples per segmentation frame"""
+	seg_resolution = SAMPLE_RATE * models.segmentation.introspection.frames.step
+	assert seg_resolution.is_integer()
+	return int(seg_resolution)
+
 
 def _speakers_num(pcm: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+	"""Returns frame level speaker indexes (-1 for non speech) and speaker embeddings"""
 	samples_num, channels = pcm.shape
 	with torch.no_grad():
-		wave = rearrange(pcm, "sample channel -> 1 channel sample").to(dtype=torch.float32)
+		segmentation_model, embedding_model = models.segmentation, models.embedding
+		wave = rearrange(pcm, "sample channel -> 1 channel sample").to(dtype=torch.float32, device=segmentation_model.device)
 		segmentations = segmentation_model(wave)  # shape (batch, frames, speakers)
 
 		batch_size, _, num_speakers = segmentations.shape
@@ -93,20 +399,12 @@ def _speakers_num(pcm: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
 			batch=batch_size,
 			spk=num_speakers
 		) # shape (batch, speakers, emb_dim)
+		segmentations, speaker_embeddings = segmentations.cpu(), speaker_embeddings.cpu()
 
-		seg_resolution = SAMPLE_RATE * segmentation_model.introspection.frames.step
-		assert seg_resolution.is_integer()
-		segmentations = repeat(segmentations, 
-			"batch frame speaker -> batch (frame samples_in_window) speaker", 
-			samples_in_window=int(seg_resolution)
-		)
 		nva_segments = (segmentations < 0.5).all(dim=2)
 		current_speaker = segmentations.argmax(dim=2)
 		current_speaker[nva_segments] = -1
-
-		pad_left_val = samples_num - current_speaker.shape[-1]
-		current_speaker = torch.nn.functional.pad(current_speaker, (pad_left_val, 0, 0, 0), 'constant', -1)
-		current_speaker = current_speaker.squeeze()
+		current_speaker = current_speaker.squeeze(0)  # shape (frames,)
 		assert batch_size == 1
 
 		assert speaker_embeddings.shape[0] == 1
@@ -115,27 +413,139 @@ def _speakers_num(pcm: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
 		return current_speaker, speaker_embeddings
 
 
-def transcriber():
+class SpeakerTurn(TypedDict):
+	start: int
+	end: int
+	speaker: str
+	text: str
+
+
+def _diarize_chunk(pcm: torch.Tensor, vad: bool = True) -> Tuple[List[Tuple[torch.Tensor, Tuple[int, int], int]], torch.Tensor]:
+	"""Diarizes a chunk, with `vad` silence is cut out before the models run.
+	Returns segments of the (compacted) audio with their times in the original chunk."""
+	speech_ranges = _speech_ranges(pcm) if vad else [(0, len(pcm))]
+	speech = _compact(pcm, speech_ranges)
+	if vad and len(speech) < VAD_MIN_SPEECH:
+		return [], torch.empty(0)
+
+	speaker_ids, speaker_embeddings = _speakers_num(speech)
+	time_ranges, speakers = _speaker_ranges(speaker_ids, len(speech), _frame_resolution())
+	speech = speech.squeeze(1)
+	return [(speech[start:end], (orig_start // SAMPLE_RATE, orig_end // SAMPLE_RATE), speaker)
+			for (start, end), (orig_start, orig_end), speaker
+			in zip(time_ranges, _restore_times(time_ranges, speech_ranges), speakers)], speaker_embeddings
+
+
+async def stream_transcribe(chunks: AsyncIterable[torch.Tensor], prefetch: int = 2,
+							decoding: str = DECODING_SEQUENTIAL,
+							speakers: Optional[SpeakerRegistry] = None, vad: bool = True,
+							overlap: float = 0) -> AsyncIterator[SpeakerTurn]:
+	"""Transcribes a stream of `CHUNK_LENGTH` PCM chunks shaped (sample, channel).
+
+	Segmentation and embedding of the following chunks run in one worker thread while
+	whisper decodes the current chunk in another one, so the event loop is never blocked.
+	Turns are yielded as soon as they are decoded, `prefetch` bounds the chunks diarized ahead.
+
+	With `DECODING_BATCHED` the segments of a chunk (and of other sessions decoding at the same
+	time) are packed into shared windows; previous text of a speaker isn't used as a prompt then.
+	Pass `speakers` to keep speaker labels of a previous stream. With `vad` silent parts of chunks
+	are dropped before segmentation and decoding, turn times still refer to the original audio.
+	`overlap` is the number of seconds consecutive chunks share (see `audio.iter_chunks`),
+	turns in the shared part are taken from the earlier chunk."""
+	if decoding not in (DECODING_SEQUENTIAL, DECODING_BATCHED):
+		raise ValueError(f'Unknown decoding mode {decoding}')
+	if speakers is None:
+		speakers = SpeakerRegistry()
+	loop = asyncio.get_running_loop()
+	diarize_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diarize')
+	decode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='decode')
+	queue = asyncio.Queue(maxsize=prefetch)
+
+	async def produce():
+		try:
+			async for pcm in chunks:
+				await queue.put(loop.run_in_executor(diarize_executor, _diarize_chunk, pcm, vad))
+		finally:
+			await queue.put(None)
+
+	producer = asyncio.create_task(produce())
+	prev_text = {}
+	num_chunk = 0
+	try:
+		while (diarized := await queue.get()) is not None:
+			segments, speaker_embeddings = await diarized
+			names = _speaker_names(speakers, [speaker_num for _, _, speaker_num in segments], speaker_embeddings)
+			turns = [(wave_seg.squeeze(), start, end, name) for (wave_seg, (start, end), _), name in zip(segments, names) if name]
+			if num_chunk > 0 and overlap:
+				turns = [turn for turn in turns if (turn[1] + turn[2]) / 2 >= overlap]
+			if decoding == DECODING_BATCHED:
+				texts = await asyncio.gather(*[_get_batcher().decode(segment) for segment, _, _, _ in turns])
+			for i, (segment, start, end, speaker_name) in enumerate(turns):
+				if decoding == DECODING_BATCHED:
+					text = texts[i]
+				else:
+					text = await loop.run_in_executor(decode_executor, _transcribe_pcm, segment, prev_text.get(speaker_name))
+				prev_text[speaker_name] = prev_text.get(speaker_name, '') + text
+				yield {'start': round(num_chunk * (CHUNK_LENGTH - overlap)) + start,
+					   'end': round(num_chunk * (CHUNK_LENGTH - overlap)) + end,
+					   'speaker': speaker_name,
+					   'text': text}
+
+			num_chunk += 1
+		await producer
+	finally:
+		producer.cancel()
+		while not queue.empty():
+			if (pending := queue.get_nowait()) is not None and not pending.cancel() and not pending.cancelled():
+				pending.exception()
+		diarize_executor.shutdown(wait=False, cancel_futures=True)
+		decode_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def transcribe_file(path, overlap: float = 0, use_cache: bool = True, **kwargs) -> List[SpeakerTurn]:
+	"""Transcribes an audio or video file, decoded audio is streamed into `stream_transcribe`.
+	Results are cached by the file content and models configuration."""
+	from crabnlp.audio import aiter_chunks
+
+	use_cache = use_cache and 'speakers' not in kwargs
+	if use_cache:
+		key = await asyncio.to_thread(cache.file_key, path, 'whisper', sorted(models.config.items()), overlap, sorted(kwargs.items()))
+		if (turns := cache.transcripts.get(key)) is not None:
+			return turns
+
+	turns = [turn async for turn in stream_transcribe(aiter_chunks(path, overlap=overlap), overlap=overlap, **kwargs)]
+	if use_cache:
+		cache.transcripts.set(key, turns)
+	return turns
+
+
+def transcriber(decoding: str = DECODING_SEQUENTIAL, speakers: Optional[SpeakerRegistry] = None, vad: bool = True):
+	if decoding not in (DECODING_SEQUENTIAL, DECODING_BATCHED):
+		raise ValueError(f'Unknown decoding mode {decoding}')
 	prev_text = {}
 	num_chunk = 0
 	prev_speaker = None
-	speakers_db = None
+	speakers_db = speakers if speakers is not None else SpeakerRegistry()
 
 	async def inner(segment_psm_s: torch.Tensor) -> str:
-		nonlocal prev_text, num_chunk, prev_speaker, speakers_db
+		nonlocal prev_text, num_chunk, prev_speaker
 		results = []
 
-		speaker_ids, speaker_embeddings = _speakers_num(segment_psm_s)
-		#if speakers_db == None:
-		speakers_db = speaker_embeddings
-		#else:
-		#	pass
+		segments, speaker_embeddings = await asyncio.to_thread(_diarize_chunk, segment_psm_s, vad)
+		names = _speaker_names(speakers_db, [speaker_num for _, _, speaker_num in segments], speaker_embeddings)
+		if decoding == DECODING_BATCHED:
+			texts = iter(await asyncio.gather(*[_get_batcher().decode(wave_seg.squeeze())
+												for (wave_seg, _, _), name in zip(segments, names) if name]))
 
-		for wave_seg, (start, end), speaker_num in _diarize_speakers(segment_psm_s, speaker_ids):
+		for (wave_seg, (start, end), _), speaker_name in zip(segments, names):
 			segment = wave_seg.squeeze()
-			speaker_name = 'Спикер ' + str(_nearest(speaker_embeddings[speaker_num], speakers_db))
 			
-			text = _transcribe_pcm(segment, prev_text.get(speaker_name))
+			if not speaker_name:
+				text = ''
+			elif decoding == DECODING_BATCHED:
+				text = next(texts)
+			else:
+				text = await asyncio.to_thread(_transcribe_pcm, segment, prev_text.get(speaker_name))
 
 			if speaker_name:
 				if speaker_name != prev_speaker and prev_speaker == None:
@@ -152,4 +562,52 @@ def transcriber():
 		num_chunk += 1
 		return ' '.join(results)
 
-	return  inner
\ No newline at end of file
+	return  inner
+
+
+def benchmark_decoding(segments: List[torch.Tensor]) -> dict:
+	"""Compares segments/second of per-segment and batched decoding"""
+	started = monotonic()
+	for pcm in segments:
+		_transcribe_pcm(pcm, None)
+	sequential = monotonic() - started
+
+	started = monotonic()
+	_transcribe_batch(segments)
+	batched = monotonic() - started
+
+	return {'segments': len(segments),
+			'sequential_segments_per_sec': len(segments) / sequential,
+			'batched_segments_per_sec': len(segments) / batched}
+
+
+def benchmark_diarization(turns: int = 40, resolution: int = 270, repeats: int = 1000) -> dict:
+	"""Times post-processing of segmentation frames of a `CHUNK_LENGTH` chunk into merged turns"""
+	frames_num = N_SAMPLES // resolution
+	generator = torch.Generator().manual_seed(0)
+	lengths = torch.randint(1, 2 * frames_num // turns, (turns,), generator=generator)
+	frame_speakers = torch.randint(-1, 3, (turns,), generator=generator).repeat_interleave(lengths)[:frames_num]
+
+	started = monotonic()
+	for _ in range(repeats):
+		_speaker_ranges(frame_speakers, N_SAMPLES, resolution)
+	elapsed = monotonic() - started
+	return {'frames': len(frame_speakers), 'ms_per_chunk': elapsed / repeats * 1000}
+
+
+if __name__ == '__main__':
+	import sys
+	import wave
+
+	print(benchmark_diarization())
+	if len(sys.argv) < 2:
+		sys.exit()
+
+	with wave.open(sys.argv[1]) as w:
+		assert w.getframerate() == SAMPLE_RATE and w.getnchannels() == 1 and w.getsampwidth() == 2, 'expecting 16 kHz mono 16-bit wav'
+		pcm = torch.frombuffer(bytearray(w.readframes(w.getnframes())), dtype=torch.int16).unsqueeze(1)
+
+	segments = [wave_seg.squeeze()
+				for i in range(0, len(pcm), N_SAMPLES)
+				for wave_seg, _, _ in _diarize_chunk(pcm[i:i + N_SAMPLES])[0]]
+	print(benchmark_decoding(segments))
@@ -0,0 +1,151 @@
+import asyncio
+import math
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple
+
+import torch
+
+from crabnlp import whisper
+from crabnlp.whisper import CHUNK_LENGTH, DECODING_BATCHED, DECODING_SEQUENTIAL, SAMPLE_RATE, SpeakerRegistry, SpeakerTurn
+
+
+PcmHandle = Tuple[str, Tuple[int, ...]]
+
+
+def _share(pcm: torch.Tensor) -> Tuple[shared_memory.SharedMemory, PcmHandle]:
+	"""Copies int16 PCM into a new shared memory block, the caller must close and unlink it"""
+	pcm = pcm.to(torch.int16).contiguous()
+	shm = shared_memory.SharedMemory(create=True, size=max(pcm.numel() * pcm.element_size(), 1))
+	torch.frombuffer(shm.buf, dtype=torch.int16, count=pcm.numel()).copy_(pcm.flatten())
+	return shm, (shm.name, tuple(pcm.shape))
+
+
+def _attach(handle: PcmHandle) -> torch.Tensor:
+	name, shape = handle
+	shm = shared_memory.SharedMemory(name=name)
+	try:
+		return torch.frombuffer(shm.buf, dtype=torch.int16, count=math.prod(shape)).reshape(shape).clone()
+	finally:
+		shm.close()
+
+
+def _init_worker(models_config: dict):
+	whisper.models.configure(**models_config)
+	# load everything before the first job comes
+	whisper.models.segmentation, whisper.models.embedding, whisper.models.transcriber
+
+
+def _diarize_job(handle: PcmHandle, vad: bool) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]], List[int], torch.Tensor]:
+	"""Returns speech ranges of the chunk and speaker ranges of the compacted speech"""
+	pcm = _attach(handle)
+	speech_ranges = whisper._speech_ranges(pcm) if vad else [(0, len(pcm))]
+	speech = whisper._compact(pcm, speech_ranges)
+	if vad and len(speech) < whisper.VAD_MIN_SPEECH:
+		return speech_ranges, [], [], torch.empty(0)
+
+	speaker_ids, speaker_embeddings = whisper._speakers_num(speech)
+	time_ranges, speakers = whisper._speaker_ranges(speaker_ids, len(speech), whisper._frame_resolution())
+	return speech_ranges, time_ranges, speakers, speaker_embeddings
+
+
+def _decode_job(handle: PcmHandle, speech_ranges: List[Tuple[int, int]], turns: List[Tuple[int, int, str]],
+				prev_text: dict, decoding: str) -> List[str]:
+	pcm = whisper._compact(_attach(handle), speech_ranges)[:, 0]
+	if decoding == DECODING_BATCHED:
+		return whisper._transcribe_batch([pcm[start:end] for start, end, _ in turns])
+
+	texts = []
+	for start, end, speaker_name in turns:
+		text = whisper._transcribe_pcm(pcm[start:end], prev_text.get(speaker_name))
+		prev_text[speaker_name] = prev_text.get(speaker_name, '') + text
+		texts.append(text)
+	return texts
+
+
+class TranscriptionPool:
+	"""Worker processes that load the models once and transcribe chunks of many sessions.
+
+	Audio is handed over to workers through shared memory, only ranges, embeddings
+	and texts are pickled."""
+	def __init__(self, workers: Optional[int] = None, threads_per_worker: int = 1, **models_config):
+		if workers is None:
+			workers = max((os.cpu_count() or 1) // threads_per_worker, 1)
+		models_config = dict(models_config, cpu_threads=threads_per_worker)
+		self.executor = ProcessPoolExecutor(max_workers=workers,
+											mp_context=mp.get_context('spawn'),
+											initializer=_init_worker,
+											initargs=(models_config,))
+
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
+
+	async def stream_transcribe(self, chunks: AsyncIterable[torch.Tensor], prefetch: int = 2,
+								decoding: str = DECODING_SEQUENTIAL,
+								speakers: Optional[SpeakerRegistry] = None, vad: bool = True,
+								overlap: float = 0) -> AsyncIterator[SpeakerTurn]:
+		"""Same as `whisper.stream_transcribe` but diarization and decoding run in the pool,
+		turns are yielded once a whole chunk is decoded"""
+		if decoding not in (DECODING_SEQUENTIAL, DECODING_BATCHED):
+			raise ValueError(f'Unknown decoding mode {decoding}')
+		if speakers is None:
+			speakers = SpeakerRegistry()
+		loop = asyncio.get_running_loop()
+		queue = asyncio.Queue(maxsize=prefetch)
+
+		async def produce():
+			try:
+				async for pcm in chunks:
+					shm, handle = _share(pcm)
+					diarized = None
+					try:
+						diarized = loop.run_in_executor(self.executor, _diarize_job, handle, vad)
+						await queue.put((shm, handle, diarized))
+					except BaseException:
+						# cancelled while waiting for a free slot, the block never reached the queue
+						if diarized is not None and not diarized.cancel():
+							diarized.add_done_callback(lambda f: f.cancelled() or f.exception())
+						shm.close()
+						shm.unlink()
+						raise
+			finally:
+				await queue.put(None)
+
+		producer = asyncio.create_task(produce())
+		prev_text = {}
+		num_chunk = 0
+		try:
+			while (item := await queue.get()) is not None:
+				shm, handle, diarized = item
+				try:
+					speech_ranges, time_ranges, speaker_nums, speaker_embeddings = await diarized
+					names = whisper._speaker_names(speakers, speaker_nums, speaker_embeddings)
+					turns = [(start, end, name) for (start, end), name in zip(time_ranges, names) if name]
+					if num_chunk > 0 and overlap:
+						turns = [turn for turn, (start, end) in zip(turns, whisper._restore_times([turn[:2] for turn in turns], speech_ranges))
+								 if (start + end) / 2 >= overlap * SAMPLE_RATE]
+					texts = await loop.run_in_executor(self.executor, _decode_job, handle, speech_ranges, turns, dict(prev_text), decoding)
+				finally:
+					shm.close()
+					shm.unlink()
+
+				times = whisper._restore_times([(start, end) for start, end, _ in turns], speech_ranges)
+				for (start, end), (_, _, speaker_name), text in zip(times, turns, texts):
+					prev_text[speaker_name] = prev_text.get(speaker_name, '') + text
+					yield {'start': round(num_chunk * (CHUNK_LENGTH - overlap)) + start // SAMPLE_RATE,
+						   'end': round(num_chunk * (CHUNK_LENGTH - overlap)) + end // SAMPLE_RATE,
+						   'speaker': speaker_name,
+						   'text': text}
+				num_chunk += 1
+			await producer
+		finally:
+			producer.cancel()
+			while not queue.empty():
+				if (item := queue.get_nowait()) is not None:
+					shm, _, diarized = item
+					if not diarized.cancel() and not diarized.cancelled():
+						diarized.exception()
+					shm.close()
+					shm.unlink()
@@ -6,7 +6,6 @@ from html import unescape
 from urllib.parse import urlparse, parse_qs
 from http.client import IncompleteRead
 from time import sleep
-import aiohttp
 import re
 import json
 from typing import Generator, List, Tuple
@@ -14,7 +13,8 @@ from html.parser import HTMLParser
 
 from pytube import YouTube
 
-from crabnlp.billing import split_by_pages
+from crabnlp.llms import split_by_pages
+from crabnlp.http_client import get_session
 
 
 ## The most effective language according to GPT-3.5-turbo byte encoding
@@ -122,21 +122,21 @@ def download_captions_and_meta(url):
 
 async def adownload_captions(video_id: str):
     url = f'https://www.youtube.com/watch?v={video_id}'
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise RuntimeError(f'Error {response.status} fetching {url}: {await response.text()}')
-
-            page = await response.text()
-            pattern = r'[uU]rl":"(https://www.youtube.com/api/timedtext.*?)"'
-            match = re.search(pattern, page)
-            if not match:
-                return
-            subtitle_url = match.group(1).replace('\\u0026', '&')
-        async with session.get(subtitle_url) as response:
-            if response.status != 200:
-                raise RuntimeError(f'Error {response.status} fetching {subtitle_url}: {await response.text()}')
-            subs = await response.text()
+    session = get_session()
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise RuntimeError(f'Error {response.status} fetching {url}: {await response.text()}')
+
+        page = await response.text()
+        pattern = r'[uU]rl":"(https://www.youtube.com/api/timedtext.*?)"'
+        match = re.search(pattern, page)
+        if not match:
+            return
+        subtitle_url = match.group(1).replace('\\u0026', '&')
+    async with session.get(subtitle_url) as response:
+        if response.status != 200:
+            raise RuntimeError(f'Error {response.status} fetching {subtitle_url}: {await response.text()}')
+        subs = await response.text()
 
     tree = ET.fromstring(subs)
     ws = []
@@ -214,11 +214,10 @@ def _extract_details(page):
 
 async def adownload_meta(vid: str):
     url = f'https://www.youtube.com/watch?v={vid}'
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise RuntimeError(f'Error {response.status} fetching {url}: {await response.text()}')
-            page = await response.text()
+    async with get_session().get(url) as response:
+        if response.status != 200:
+            raise RuntimeError(f'Error {response.status} fetching {url}: {await response.text()}')
+        page = await response.text()
     return _extract_details(page)
 
 
@@ -256,11 +255,10 @@ async def adownload_captions_and_meta(vid: str) -> dict:
     meta = await adownload_meta(vid)
     track = _select_track(meta['captionTracks'])
     if track is not None and (base_url := track.get('baseUrl')):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url) as response:
-                if response.status != 200:
-                    raise RuntimeError(f'Error {response.status} fetching {base_url}: {await response.text()}')
-                subs = await response.text()
+        async with get_session().get(base_url) as response:
+            if response.status != 200:
+                raise RuntimeError(f'Error {response.status} fetching {base_url}: {await response.text()}')
+            subs = await response.text()
 
         tree = ET.fromstring(subs)
         ws = []